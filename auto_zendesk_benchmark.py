@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Offline crawler benchmark: every collection mode crawls a fresh AutoZendeskMockServer
+and the pages/sec and bytes/sec of the crawl are reported.
+
+    python auto_zendesk_benchmark.py --posts 3000 --latency 0.05 --modes files segments
+"""
+
+# core mods
+import argparse
+import shutil
+import tempfile
+import time
+
+# 3rd party mods
+from auto_zendesk_crawling_new import AutoZendeskCrawling
+from auto_zendesk_mock_server import AutoZendeskMockServer
+
+# name of each collection mode and the crawler arguments it uses
+MODES = (
+    ('files', {}),
+    ('files-gzip', {'compression': 'gzip'}),
+    ('segments', {'output': 'segments'}),
+    ('memory', {'output': None}),
+    ('delta-posts', {'delta_posts': True}),
+    ('incremental', {'incremental': True}),
+    ('search', {'search_discovery': True}),
+    ('fixed-workers', {'adaptive_concurrency': False}),
+    ('http-cache', {'http_cache_size': 256 * 1024 * 1024}),
+)
+
+
+def _crawl(mock, save_path, options, max_workers):
+    """
+    crawl the mock server once.
+    :return: (seconds, counters of the mock server for this crawl)
+    """
+    before = mock.get_counters()
+    crawler = AutoZendeskCrawling(token='Basic bW9jaw==', max_workers=max_workers, save_path=save_path,
+                                  api_url=mock.url, **options)
+    started = time.monotonic()
+    crawler.run_all()
+    seconds = time.monotonic() - started
+    after = mock.get_counters()
+    return seconds, dict((key, after[key] - before[key]) for key in after)
+
+
+def run_benchmark(modes=None, max_workers=8, **server_options):
+    """
+    benchmark the crawl of each collection mode against its own mock server.
+    the http-cache mode crawls twice and reports the second crawl, served from the warm cache.
+    :param modes: names of the modes to run, all of MODES when None
+    :param max_workers: max_workers of the crawler
+    :param server_options: arguments of AutoZendeskMockServer(posts, latency, throttle_rate...)
+    :return: list of dict with 'mode', 'seconds', 'pages', 'bytes', 'pages_per_sec', 'bytes_per_sec',
+             'throttled' and 'errors'
+    """
+    results = []
+    for name, options in MODES:
+        if modes and name not in modes:
+            continue
+        mock = AutoZendeskMockServer(**server_options)
+        mock.start()
+        save_path = tempfile.mkdtemp(prefix='zendesk_benchmark_')
+        try:
+            seconds, counters = _crawl(mock, save_path, options, max_workers)
+            if name == 'http-cache':
+                seconds, counters = _crawl(mock, save_path, options, max_workers)
+        finally:
+            mock.stop()
+            shutil.rmtree(save_path, ignore_errors=True)
+
+        pages = counters['pages'] + counters['not_modified']
+        results.append({'mode': name,
+                        'seconds': seconds,
+                        'pages': pages,
+                        'bytes': counters['bytes'],
+                        'pages_per_sec': pages / seconds if seconds else 0.0,
+                        'bytes_per_sec': counters['bytes'] / seconds if seconds else 0.0,
+                        'throttled': counters['throttled'],
+                        'errors': counters['errors']})
+    return results
+
+
+def print_results(results):
+    print("{0:<14}{1:>9}{2:>8}{3:>12}{4:>11}{5:>13}{6:>10}{7:>8}".format(
+        'mode', 'seconds', 'pages', 'bytes', 'pages/sec', 'bytes/sec', 'throttled', 'errors'))
+    for result in results:
+        print("{mode:<14}{seconds:>9.2f}{pages:>8}{bytes:>12}{pages_per_sec:>11.1f}{bytes_per_sec:>13.0f}"
+              "{throttled:>10}{errors:>8}".format(**result))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the crawler against a local mock of the Zendesk api')
+    parser.add_argument('--modes', nargs='*', choices=[name for name, _ in MODES])
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--posts', type=int, default=300)
+    parser.add_argument('--tickets', type=int, default=300)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--comments-per-thread', type=int, default=5)
+    parser.add_argument('--page-size', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    print_results(run_benchmark(modes=args.modes, max_workers=args.max_workers, posts=args.posts,
+                                tickets=args.tickets, users=args.users,
+                                comments_per_thread=args.comments_per_thread, page_size=args.page_size,
+                                latency=args.latency, error_rate=args.error_rate,
+                                throttle_rate=args.throttle_rate))
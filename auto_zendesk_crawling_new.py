@@ -34,70 +34,708 @@ Created on Thu Jan 18 14:06:16 2018
             01/2018 0.1-Beta: build zendesk auto collect function
 """
 # core mods
-import codecs
 import os
 import json
 import time
-import datetime
 import re
+import random
+import threading
+import urllib.parse
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 3rd party mods
 import configure
+import auto_zendesk_storage as storage
+import auto_zendesk_telemetry as telemetry
+import auto_zendesk_timestamps as timestamps
+
+
+# top level paging fields read from a saved page without parsing the whole document
+_PAGE_FIELDS = ('page_count', 'next_page', 'after_url', 'after_cursor', 'end_of_stream')
+_PAGE_FIELD_PATTERN = re.compile(r'"(' + '|'.join(_PAGE_FIELDS) + r')"\s*:\s*'
+                                 r'(null|true|false|-?[0-9]+|"(?:[^"\\]|\\.)*")')
+
+
+# fields of posts and tickets kept in memory when the crawler saves nothing
+_OBSERVED_FIELDS = ('id', 'updated_at', 'comment_count', 'status', 'author_id', 'submitter_id', 'assignee_id')
+
+# user id fields of posts, comments, tickets and ticket comments resolved by the users collection
+_USER_ID_FIELDS = ('author_id', 'submitter_id', 'assignee_id')
+
+# comment threads are fetched open first, then by the time they were updated, latest first
+# statuses of tickets and of community posts('none' is a post without answer), any other status ranks 2
+_STATUS_PRIORITY = {'new': 0, 'open': 0, 'pending': 0, 'none': 0, 'hold': 1, 'planned': 1}
+
+
+class ZendeskRequestError(Exception):
+    """
+    raised when a request still fails after all retries of the scheduler.
+    """
+    def __init__(self, url, reason):
+        super().__init__("{0}: {1}".format(url, reason))
+        self.url = url
+        self.reason = reason
+
+
+class ZendeskConcurrencyController(object):
+    def __init__(self, min_limit=1, max_limit=8, initial_limit=None, latency_target=2.0, window=20):
+        """
+        AIMD limit of the requests in flight.
+        after every window of finished requests the limit grows by one while latency and throttling are healthy,
+        and is halved as soon as a request was throttled(429, 5xx) or the average latency went over the target.
+        :param min_limit: lowest limit
+        :param max_limit: highest limit, the crawler never runs more workers than this
+        :param initial_limit: limit to start with, defaults to half of max_limit
+        :param latency_target: average seconds to the response headers considered healthy
+        :param window: number of finished requests between two decisions
+        """
+        self._min_limit = max(1, min_limit)
+        self._max_limit = max(self._min_limit, max_limit)
+        self._limit = min(self._max_limit, max(self._min_limit, initial_limit or self._max_limit // 2))
+        self._latency_target = latency_target
+        self._window = window
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._latencies = []
+        self._throttled = 0
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def acquire(self):
+        """
+        block until one more request is allowed in flight.
+        :return: None
+        """
+        with self._cond:
+            while self._in_flight >= self._limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, latency, throttled=False):
+        """
+        report a finished request, the limit is adjusted once a window of requests is reported.
+        :param latency: seconds the request took
+        :param throttled: the server answered 429 or 5xx
+        :return: None
+        """
+        with self._cond:
+            self._in_flight -= 1
+            self._latencies.append(latency)
+            if throttled:
+                self._throttled += 1
+
+            if self._throttled or len(self._latencies) >= self._window:
+                average = sum(self._latencies) / len(self._latencies)
+                old_limit = self._limit
+                if self._throttled or average > self._latency_target:
+                    self._limit = max(self._min_limit, self._limit // 2)
+                else:
+                    self._limit = min(self._max_limit, self._limit + 1)
+                if self._limit != old_limit:
+                    print("concurrency {0} -> {1}: average latency {2:.2f}s, {3} throttled of {4} requests".format(
+                        old_limit, self._limit, average, self._throttled, len(self._latencies)))
+                self._latencies = []
+                self._throttled = 0
+            self._cond.notify_all()
+
+
+class ZendeskRequestScheduler(object):
+    def __init__(self, session, requests_per_minute=400, max_retries=5, backoff_base=1.0, backoff_cap=60.0,
+                 controller=None, telemetry=None, request_budget=None):
+        """
+        Central scheduler every crawler request goes through.
+        A token bucket keeps the request rate under the account's api limit, X-Rate-Limit-Remaining
+        and Retry-After of Zendesk responses are honoured, and failed requests are retried with
+        jittered exponential backoff so only the failing request waits.
+        :param session: requests.Session used to send the requests
+        :param requests_per_minute: api limit of the Zendesk account, updated from X-Rate-Limit when reported
+        :param max_retries: retries of a single request before giving up
+        :param backoff_base: first backoff delay in seconds
+        :param backoff_cap: maximum backoff delay in seconds
+        :param controller: ZendeskConcurrencyController limiting the requests in flight, None for no limit
+        :param telemetry: auto_zendesk_telemetry.CrawlTelemetry recording every attempt, None for no telemetry
+        :param request_budget: maximum number of requests sent, retries included, None for no limit
+        """
+        self._session = session
+        self._budget_left = request_budget
+        self._controller = controller
+        self._telemetry = telemetry
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_cap = backoff_cap
+
+        self._lock = threading.Lock()
+        self._capacity = float(requests_per_minute)
+        self._tokens = self._capacity
+        self._last_fill = time.monotonic()
+        # no request is sent before this moment, set by Retry-After of a throttled response
+        self._pause_until = 0.0
+
+    def _fill_rate(self):
+        return self._capacity / 60.0
+
+    def budget_exhausted(self):
+        """
+        :return: True if the request budget is spent
+        """
+        with self._lock:
+            return self._budget_left is not None and self._budget_left <= 0
+
+    def _spend(self, url):
+        """
+        take one request from the budget.
+        :param url: url about to be requested
+        :return: None
+        """
+        with self._lock:
+            if self._budget_left is None:
+                return
+            if self._budget_left <= 0:
+                raise ZendeskRequestError(url, 'request budget exhausted')
+            self._budget_left -= 1
+
+    def _acquire(self):
+        """
+        block until the token bucket and the Retry-After pause allow one more request.
+        :return: None
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last_fill) * self._fill_rate())
+                self._last_fill = now
+                wait = self._pause_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self._fill_rate()
+            time.sleep(wait)
+
+    def _observe(self, response):
+        """
+        align the bucket with the rate limit headers of a response.
+        :param response: requests.Response
+        :return: seconds to wait given by Retry-After, 0 if not present
+        """
+        limit = response.headers.get('X-Rate-Limit')
+        remaining = response.headers.get('X-Rate-Limit-Remaining')
+        retry_after = response.headers.get('Retry-After')
+        with self._lock:
+            if limit and limit.isdigit() and int(limit) > 0:
+                self._capacity = float(limit)
+            if remaining and remaining.isdigit():
+                # the server knows the budget left for the whole account, never spend more than that
+                self._tokens = min(self._tokens, float(remaining))
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    delay = 0
+                if delay > 0:
+                    # the limit is shared by the account, so every request waits for it
+                    self._pause_until = max(self._pause_until, time.monotonic() + delay)
+                    return delay
+        return 0
+
+    def _backoff(self, attempt):
+        """
+        full jitter exponential backoff delay.
+        :param attempt: number of the failed attempt, starts from 0
+        :return: seconds to wait
+        """
+        return random.uniform(0, min(self._backoff_cap, self._backoff_base * 2 ** attempt))
+
+    def get(self, url, **kwargs):
+        """
+        send a GET request through the scheduler.
+        :param url: url to request
+        :param kwargs: extra arguments of requests.Session.get
+        :return: successful requests.Response
+        """
+        reason = ''
+        for attempt in range(self._max_retries + 1):
+            self._spend(url)
+            self._acquire()
+            if self._controller is not None:
+                self._controller.acquire()
+            started = time.monotonic()
+            try:
+                r = self._session.get(url, **kwargs)
+            except requests.RequestException as e:
+                reason = str(e)
+                if self._controller is not None:
+                    self._controller.release(time.monotonic() - started, throttled=True)
+                if self._telemetry is not None:
+                    self._telemetry.observe_request(url, 'error', time.monotonic() - started, attempt)
+            else:
+                # streamed bodies are downloaded after this, the latency is the time to the headers
+                latency = time.monotonic() - started
+                if self._controller is not None:
+                    self._controller.release(latency, throttled=r.status_code == 429 or r.status_code >= 500)
+                if self._telemetry is not None:
+                    self._telemetry.observe_request(url, r.status_code, latency, attempt)
+                retry_after = self._observe(r)
+                if r.status_code == 429 or r.status_code >= 500:
+                    reason = 'HTTP {0}'.format(r.status_code)
+                    r.close()
+                    if retry_after:
+                        # waiting is done by the shared pause in _acquire
+                        continue
+                elif r.status_code >= 400:
+                    # client errors (deleted post, no permission) will not succeed by retrying
+                    r.close()
+                    raise ZendeskRequestError(url, 'HTTP {0}'.format(r.status_code))
+                else:
+                    return r
+            if attempt < self._max_retries:
+                time.sleep(self._backoff(attempt))
+        raise ZendeskRequestError(url, reason)
+
+
+# subdomain of a Zendesk instance, <subdomain>.zendesk.com
+_SUBDOMAIN_PATTERN = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+
 
 class AutoZendeskCrawling(object):
-    def __init__(self, username='', passwd='', token=""):
+    def __init__(self, username='', passwd='', token="", max_workers=8, pool_size=None, rate_limit=400,
+                 incremental=False, db=None, delta_posts=False, compression=None, output='files',
+                 subdomain='jetadvantage', instances=None, save_path=None, http_cache_size=None,
+                 adaptive_concurrency=True, api_url=None, request_budget=None, search_discovery=False):
         """
         Collect data(posts, comments, users, topics) from zendesk forum.
         :param username: username of Zendesk JetAdvantage Support forum
         #:param passwd: password of Zendesk JetAdvantage Support forum
         :param chrome_driver_path: path of chromedriver.exe tool, normally put in the same path as chrome.exe
-
+        :param max_workers: maximum number of pages downloaded at the same time, 1 means sequential
+        :param pool_size: number of keep-alive connections kept open, defaults to max_workers
+        :param rate_limit: api requests per minute allowed for the Zendesk account
+        :param incremental: collect only tickets changed since the last run with the incremental export api
+        :param db: AutoZendeskDB instance, if given comment threads unchanged since the last database update
+                   are not collected again
+        :param delta_posts: collect posts sorted by updated_at and stop at the first page older than
+                            self._LATEST_DAYS_DATA_TO_COLLECT days, older posts are kept from the database snapshot
+        :param compression: None, 'gzip' or 'zstd', compression of the saved pages
+        :param output: 'files' saves one json file per api page, 'segments' appends the records to one
+                       JSONL segment per entity type of this run(auto_zendesk_storage.RecordStore),
+                       None saves nothing, pages only go to the page sink(see set_page_sink)
+        :param subdomain: subdomain of the Zendesk instance, eg. 'jetadvantage' for jetadvantage.zendesk.com
+        :param instances: list of dict, one per Zendesk instance to crawl instead of subdomain, with keys
+                          'subdomain', 'token' and optionally 'username', 'passwd', 'rate_limit', 'db' and 'api_url'.
+                          every instance is crawled concurrently by its own crawler with its own rate limit budget
+                          and saved under OUTPUT_PATH/<subdomain>, other parameters apply to all instances
+        :param save_path: folder the crawl is saved in, defaults to configure.OUTPUT_PATH
+        :param http_cache_size: size limit in bytes of the validator cache(auto_zendesk_storage.ValidatorCache),
+                                pages are requested with If-None-Match/If-Modified-Since and the cached body
+                                is reused on 304 Not Modified. None disables the cache
+        :param adaptive_concurrency: adjust the requests in flight between 1 and max_workers to the latency and
+                                     throttling of the api(ZendeskConcurrencyController), False keeps max_workers
+        :param api_url: base url of the api instead of https://<subdomain>.zendesk.com/api/v2/,
+                        eg. the url of auto_zendesk_mock_server.AutoZendeskMockServer
+        :param request_budget: maximum number of api requests of a run. with a budget the comment threads of
+                               posts and tickets are fetched together from one queue, open and latest updated
+                               first, so the threads that matter are fresh when the budget runs out.
+                               a run stopped by the budget is continued by resume()
+        :param search_discovery: find the posts and tickets updated in the collection window with the search api
+                                 instead of listing every post and ticket, the search results are saved as the
+                                 posts and tickets pages. a failed search falls back to the listing
         """
         self._token = token
         self._header = {'Authorization': self._token}
         self._username = username
         self._passwd = passwd
-        self._save_path = configure.OUTPUT_PATH
+        self._save_path = save_path or configure.OUTPUT_PATH
+
+        if not _SUBDOMAIN_PATTERN.match(subdomain):
+            raise ValueError("invalid Zendesk subdomain {0}".format(subdomain))
+        self._subdomain = subdomain
+
+        # one crawler per Zendesk instance, this crawler only runs them
+        self._instances = []
+        for instance in instances or []:
+            self._instances.append(AutoZendeskCrawling(username=instance.get('username', username),
+                                                       passwd=instance.get('passwd', passwd),
+                                                       token=instance['token'],
+                                                       max_workers=max_workers,
+                                                       pool_size=pool_size,
+                                                       rate_limit=instance.get('rate_limit', rate_limit),
+                                                       incremental=incremental,
+                                                       db=instance.get('db'),
+                                                       delta_posts=delta_posts,
+                                                       compression=compression,
+                                                       output=output,
+                                                       subdomain=instance['subdomain'],
+                                                       save_path=os.path.join(self._save_path,
+                                                                              instance['subdomain']),
+                                                       http_cache_size=http_cache_size,
+                                                       adaptive_concurrency=adaptive_concurrency,
+                                                       api_url=instance.get('api_url'),
+                                                       request_budget=request_budget,
+                                                       search_discovery=search_discovery))
 
         # total page of posts
         # set to 1 when initial and it will dynamically updated running post collection function
         self._total_page = 1
-        self._zendesk_hc_entrance = r'https://jetadvantage.zendesk.com/hc/en-us'
-        self._zendesk_api_entrance = r'https://jetadvantage.zendesk.com/api/v2/'
+        self._zendesk_hc_entrance = r'https://{0}.zendesk.com/hc/en-us'.format(subdomain)
+        self._zendesk_api_entrance = api_url or r'https://{0}.zendesk.com/api/v2/'.format(subdomain)
 
         # total page of tickets
         self._total_ticket = 1
 
         # this parameter determine how may days(latest days) of data to collect
         self._LATEST_DAYS_DATA_TO_COLLECT = 5
+        # start of the collection window, computed once per run by _window_start()
+        self._window = None
 
         # sleep some seconds after logged in zendesk to wait the page full loaded to browswe
         # when having a bad network connection
         self._SLEEP_AFTER_LOG_IN = 5
 
-        self._posts_id = []
+        # maximum number of concurrent page downloads
+        self._MAX_WORKERS = max(1, max_workers)
+
+        # saved pages are compressed with this, readers decompress them by file extension
+        storage.check_compression(compression)
+        self._COMPRESSION = compression
+
+        if output not in ('files', 'segments', None):
+            raise ValueError("unknown output {0}, use 'files', 'segments' or None".format(output))
+        self._OUTPUT = output
+        self._store = None
+        self._manifest = None
+        self._open_run(time.strftime('%Y%m%d_%H%M%S'))
+
+        # called with (entity, parent id, records) for every collected page, see set_page_sink
+        self._page_sink = None
+        # without any output, the few fields needed to pick comment threads and users to collect are kept here
+        self._observed = {'posts': [], 'comments': [], 'tickets': [], 'ticket_comments': []}
+        self._observed_lock = threading.Lock()
+
+        # responses are streamed to disk in chunks of this size
+        self._CHUNK_SIZE = 64 * 1024
+        # bytes kept from the start and the end of a response to read the paging fields
+        self._FIELD_WINDOW = 4096
+
+        # one long-lived keep-alive session shared by every api call,
+        # the pool is sized to the crawl concurrency so no worker waits for or drops a connection
+        self._POOL_SIZE = pool_size or self._MAX_WORKERS
+        self._session = self._build_session()
+
+        # requests in flight follow the health of the api instead of a fixed worker count
+        self._controller = None
+        if adaptive_concurrency:
+            self._controller = ZendeskConcurrencyController(max_limit=self._MAX_WORKERS)
+
+        # requests, latency and bytes of every endpoint, written to OUTPUT_PATH/metrics at the end of a run
+        self._telemetry = telemetry.CrawlTelemetry()
+
+        # every request goes through the scheduler to stay under the account's rate limit
+        self._REQUEST_BUDGET = request_budget
+        self._scheduler = ZendeskRequestScheduler(self._session, requests_per_minute=rate_limit,
+                                                  controller=self._controller, telemetry=self._telemetry,
+                                                  request_budget=request_budget)
+
+        # bodies of unchanged pages are reused from here instead of downloaded again
+        self._http_cache = None
+        if http_cache_size:
+            self._http_cache = storage.ValidatorCache(self._save_path, max_bytes=http_cache_size)
+
+        # ids of the threads to collect, array('q') keeps millions of ids compact
+        self._posts_id = timestamps.id_array()
         self._json_posts_filename_list = []
 
-        self._tickets_id = []
+        self._tickets_id = timestamps.id_array()
         self._json_tickets_filename_list = []
 
-    def _get_page_count(self):
+        # state of the threads already stored in database, loaded by _load_thread_state()
+        self._db = db
+        self._known_posts = dict()
+        self._known_tickets = dict()
+        self._known_users = set()
+        # (entity, id) -> (status rank, updated_at) of the threads to collect, see _STATUS_PRIORITY
+        self._thread_priority = dict()
+        # (entity, id) -> (updated_at, comment_count) of the threads to collect, and the thread state records
+        # of the threads fully collected, saved with their comments by _save_thread_state()
+        self._thread_state = dict()
+        self._collected_state = []
+        # show_many endpoints accept at most 100 ids
+        self._SHOW_MANY_BATCH_SIZE = 100
+
+        self._DELTA_POSTS = delta_posts
+
+        self._SEARCH_DISCOVERY = search_discovery
+        # a search returns at most this many results, see _collect_search
+        self._SEARCH_RESULT_LIMIT = 1000
+
+        # sync state(incremental export cursor...) kept between runs
+        self._INCREMENTAL = incremental
+        self._state_path = os.path.join(self._save_path, 'state')
+        self._sync_state_file = os.path.join(self._state_path, 'sync_state.json')
+
+        # progress of the running crawl, resume() continues from it after a crash
+        self._checkpoint_file = os.path.join(self._state_path, 'checkpoint.json')
+        self._checkpoint = {'run_id': self._run_id, 'finished': False, 'stages': dict()}
+        self._checkpoint_lock = threading.RLock()
+        self._checkpoint_saved_at = 0
+        # seconds between two checkpoint saves while comment threads are collected
+        self._CHECKPOINT_INTERVAL = 5
+        # the sync daemon calls do not belong to a crawl run and are not saved in the checkpoint
+        self._checkpointing = True
+
+    def _open_run(self, run_id):
         """
-        update the right total page count based on the first collected post json file.
+        open the outputs(segment store or manifest) of a crawl run.
+        :param run_id: id of the run, a resumed run keeps the id of the interrupted one
         :return: None
         """
-        file = os.path.join(self._save_path, 'post1.json')
+        self._run_id = run_id
+        if self._OUTPUT == 'segments':
+            self._store = storage.RecordStore(self._save_path, self._run_id)
+        elif self._OUTPUT == 'files':
+            # every saved page is listed in the manifest of this run
+            self._manifest = storage.CrawlManifest(self._save_path, self._run_id)
+
+    def _build_session(self):
+        """
+        build the pooled http session, authorization header is set once here.
+        :return: requests.Session
+        """
+        session = requests.Session()
+        session.headers.update(self._header)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self._POOL_SIZE,
+                                                pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_connection_stats(self):
+        """
+        connection reuse counters of the pooled session.
+        every request not opening a new connection reused a kept-alive one (no new TCP+TLS handshake).
+        :return: dict with 'requests', 'connections' and 'reused' counts, summed over the instances
+        """
+        requests_cnt = 0
+        connections_cnt = 0
+        for crawler in self._instances:
+            stats = crawler.get_connection_stats()
+            requests_cnt += stats['requests']
+            connections_cnt += stats['connections']
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_cnt += pool.num_requests
+                connections_cnt += pool.num_connections
+        return {'requests': requests_cnt,
+                'connections': connections_cnt,
+                'reused': requests_cnt - connections_cnt}
+
+    def _print_connection_stats(self):
+        stats = self.get_connection_stats()
+        print("{requests} requests over {connections} connections, {reused} reused".format(**stats))
+        if self._http_cache is not None:
+            print("http cache: {hits} hits, {misses} misses, {entries} entries in {bytes} bytes".format(
+                **self._http_cache.stats()))
+
+    def _load_state_file(self, state_file):
+        """
+        load a state(sync state, checkpoint...) saved by a previous run.
+        :param state_file: path of the state file
+        :return: dict of state, empty if there is no state yet
+        """
+        if not os.path.exists(state_file):
+            return {}
+        try:
+            with open(state_file, 'r', encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            print("ERROR: can not load state {0}, start from scratch".format(state_file))
+            return {}
+
+    def _save_state_file(self, state_file, state):
+        """
+        save a state, the file is replaced atomically so a crash never leaves half a state.
+        sets in the state are saved as sorted lists.
+        :param state_file: path of the state file
+        :param state: dict of state
+        :return: None
+        """
+        os.makedirs(self._state_path, exist_ok=True)
+        tmp_file = state_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as f:
+            json.dump(state, f, default=sorted)
+        os.replace(tmp_file, state_file)
+
+    def _new_checkpoint(self):
+        """
+        start the checkpoint of a new crawl run.
+        :return: None
+        """
+        with self._checkpoint_lock:
+            self._checkpoint = {'run_id': self._run_id, 'finished': False, 'stages': dict()}
+            self._save_state_file(self._checkpoint_file, self._checkpoint)
+            self._checkpoint_saved_at = time.time()
+
+    def _checkpoint_stage(self, stage):
+        """
+        progress of one stage of the running crawl.
+        pages collected and comment threads collected are kept as sets under 'pages' and 'done_ids',
+        they are changed in place and saved as sorted lists.
+        :param stage: 'posts', 'comments', 'topics', 'tickets' or 'ticket_comments'
+        :return: dict of the stage progress
+        """
+        with self._checkpoint_lock:
+            progress = self._checkpoint['stages'].get(stage)
+            if progress is None:
+                progress = {'pages': set(), 'done_ids': set()}
+                self._checkpoint['stages'][stage] = progress
+            return progress
+
+    def _update_checkpoint(self, stage, force=False, add=None, **values):
+        """
+        record the progress of a stage, the checkpoint is saved at most every few seconds unless forced.
+        :param stage: 'posts', 'comments', 'topics', 'tickets' or 'ticket_comments'
+        :param force: save the checkpoint now
+        :param add: (key, value) to add to the set under key, eg. ('done_ids', '1234')
+        :param values: values of the stage progress to set, eg. next_page=url
+        :return: None
+        """
+        progress = self._checkpoint_stage(stage)
+        with self._checkpoint_lock:
+            progress.update(values)
+            if add is not None:
+                progress[add[0]].add(add[1])
+            if not self._checkpointing:
+                return
+            if force or time.time() - self._checkpoint_saved_at >= self._CHECKPOINT_INTERVAL:
+                self._save_state_file(self._checkpoint_file, self._checkpoint)
+                self._checkpoint_saved_at = time.time()
+
+    def _load_thread_state(self):
+        """
+        load {id: state} maps of the comment threads stored in database(isv_thread_state),
+        the comment crawl skips threads whose state did not change and the users collection skips stored users.
+        :return: None
+        """
+        if self._db is None:
+            return
+        self._known_posts = self._db.get_posts_thread_state()
+        self._known_tickets = self._db.get_tickets_thread_state()
+        self._known_users = self._db.get_known_user_ids()
+        print("loaded state of {0} posts, {1} tickets and {2} users".format(len(self._known_posts),
+                                                                         len(self._known_tickets),
+                                                                         len(self._known_users)))
+
+    @staticmethod
+    def _extract_page_fields(head, tail, full_path):
+        """
+        pull the small top level paging fields out of a saved page without parsing the whole document.
+        Zendesk puts them before or after the records array, so the first and the last bytes of the
+        response are enough. the full document is parsed only if none of them is found there.
+        :param head: first bytes of the response
+        :param tail: last bytes of the response
+        :param full_path: path of the saved page
+        :return: dict of the paging fields found in the page, None if the page is not json
+        """
+        fields = dict()
+        for window in (head, tail):
+            text = window.decode('utf8', errors='ignore')
+            for m in _PAGE_FIELD_PATTERN.finditer(text):
+                fields[m.group(1)] = json.loads(m.group(2))
+        if fields:
+            return fields
+
+        # fall back to the full document
         try:
-            with open(file, 'r', encoding='utf8') as f:
-                data = json.load(f)
-                return data['page_count']
-        except IOError:
-            print("ERROR: IO ERROR when load {0}".format(file))
-            quit()
-        except json.JSONDecodeError:
-            print("ERROR: Json file {0} decode error!".format(file))
-            quit()
+            data = storage.load_json(full_path)
+        except (OSError, EOFError, ValueError):
+            print("ERROR: Json file {0} decode error!".format(full_path))
+            return None
+        if isinstance(data, dict):
+            for key in _PAGE_FIELDS:
+                if key in data:
+                    fields[key] = data[key]
+        return fields
+
+    def _iter_records(self, entity, file_names):
+        """
+        stream the collected records of one entity type, from the segment store or the saved pages.
+        :param entity: entity type eg. 'posts'
+        :param file_names: saved pages of the entity, not used with the segment store
+        :return: generator of (parent id, record)
+        """
+        if self._store is not None:
+            return self._store.iter_records(entity)
+        if self._manifest is None:
+            with self._observed_lock:
+                return iter([(None, record) for record in self._observed.get(entity, [])])
+        return storage.iter_file_records(file_names, entity)
+
+    def _iter_readable_records(self, entity, file_names):
+        """
+        stream the collected records like _iter_records, a saved page that can not be read is reported and skipped.
+        :param entity: entity type eg. 'posts'
+        :param file_names: saved pages of the entity, not used with the segment store
+        :return: generator of (parent id, record)
+        """
+        if self._store is not None or self._manifest is None:
+            for item in self._iter_records(entity, file_names):
+                yield item
+            return
+        for file_name in file_names:
+            try:
+                records = storage.page_records(entity, storage.load_json(file_name))
+            except (OSError, EOFError, ValueError):
+                print("ERROR: can not load {0}, its {1} are skipped".format(file_name, entity))
+                continue
+            parent_id = storage.describe_page(file_name)[1]
+            for record in records:
+                yield parent_id, record
+
+    def set_page_sink(self, sink):
+        """
+        hand every collected page to sink while crawling, used by the crawler to database pipeline.
+        :param sink: callable(entity, parent id, records), it may block to slow the crawl down.
+                     with several instances the sink gets the pages of all of them,
+                     use get_instance_crawlers() to give every instance its own sink
+        :return: None
+        """
+        self._page_sink = sink
+        for crawler in self._instances:
+            crawler.set_page_sink(sink)
+
+    def get_instance_crawlers(self):
+        """
+        crawlers of the instances given to this crawler.
+        :return: dict of subdomain to AutoZendeskCrawling, this crawler only if it crawls a single instance
+        """
+        if not self._instances:
+            return {self._subdomain: self}
+        return {crawler._subdomain: crawler for crawler in self._instances}
+
+    def _emit_page(self, file_name, data):
+        """
+        pass the records of a collected page to the page sink,
+        and keep what the comment collection needs when nothing is saved.
+        :param file_name: file name of the page, gives entity type and parent id of the records
+        :param data: parsed page
+        :return: None
+        """
+        entity, parent_id, _ = storage.describe_page(file_name)
+        records = storage.page_records(entity, data)
+        if self._page_sink is not None:
+            self._page_sink(entity, parent_id, records)
+        if self._store is None and self._manifest is None and entity in self._observed:
+            kept = [{key: record.get(key) for key in _OBSERVED_FIELDS} for record in records]
+            with self._observed_lock:
+                self._observed[entity].extend(kept)
 
     def _parse_json_posts_file(self):
         """
@@ -105,39 +743,38 @@ class AutoZendeskCrawling(object):
         only load post witch is updated in self._LATEST_DAYS_DATA_TO_COLLECT days.
         :return: None
         """
-        for file in self._json_posts_filename_list:
-            try:
-                with open(file, 'r', encoding='utf8') as f:
-                    data = json.load(f)
-                    posts = data['posts']
-                    for post in posts:
-                        update_str = post['updated_at']
-                        update_time = datetime.datetime.strptime(update_str, "%Y-%m-%dT%H:%M:%SZ")
-
-                        c_time = datetime.datetime.now()
-                        days = (c_time - update_time).days
-
-                        # only collects those posts' comments which has been updated in n days
-                        if days < self._LATEST_DAYS_DATA_TO_COLLECT:
-                            # print(post['id'], update_time)
-                            # print(days)
-                            self._posts_id.append(str(post['id']))
-            except IOError:
-                print("ERROR: IO ERROR when load {0}".format(file))
-                quit()
-            except json.JSONDecodeError:
-                print("ERROR: Json file {0} decode error!".format(file))
-                quit()
+        # timestamps are compared as strings with the window start, no record is parsed
+        window_start = self._window_start()
+        for _, post in self._iter_readable_records('posts', self._json_posts_filename_list):
+            update_str = post['updated_at']
+
+            # only collects those posts' comments which has been updated in n days
+            if timestamps.is_after(update_str, window_start):
+                known = self._known_posts.get(str(post['id']))
+                if known == (update_str, post['comment_count']):
+                    # comments did not change since the thread was stored
+                    continue
+                self._posts_id.append(int(post['id']))
+                self._thread_priority[('posts', str(post['id']))] = (
+                    _STATUS_PRIORITY.get(post.get('status'), 2), update_str)
+                self._thread_state[('posts', str(post['id']))] = (update_str, post['comment_count'])
 
     def _build_json_posts_file_list(self):
         """
         build posts json file list.
         :return: None
         """
-        for root, dirs, files in os.walk(self._save_path):
-            for file in files:
-                if re.match('^post.*.json', file):
-                    self._json_posts_filename_list.append(os.path.join(self._save_path, file))
+        self._json_posts_filename_list = self._list_pages('posts')
+
+    def _list_pages(self, entity):
+        """
+        list the pages of one entity type saved by this run from the manifest.
+        :param entity: entity type eg. 'posts'
+        :return: list of page paths
+        """
+        if self._manifest is None:
+            return []
+        return self._manifest.files(entity)
 
     def _parse_json_tickets_file(self):
         """
@@ -145,39 +782,27 @@ class AutoZendeskCrawling(object):
         only load ticket(s) witch is updated in self._LATEST_DAYS_DATA_TO_COLLECT days.
         :return: None
         """
-        for file in self._json_tickets_filename_list:
-            try:
-                with open(file, 'r', encoding='utf8') as f:
-                    data = json.load(f)
-                    tickets = data['tickets']
-                    for ticket in tickets:
-                        update_str = ticket['updated_at']
-                        update_time = datetime.datetime.strptime(update_str, "%Y-%m-%dT%H:%M:%SZ")
-
-                        c_time = datetime.datetime.now()
-                        days = (c_time - update_time).days
-
-                        # only collects those posts' comments which has been updated in n days
-                        if days < self._LATEST_DAYS_DATA_TO_COLLECT:
-                            # print(post['id'], update_time)
-                            # print(days)
-                            self._tickets_id.append(str(ticket['id']))
-            except IOError:
-                print("ERROR: IO ERROR when load {0}".format(file))
-                quit()
-            except json.JSONDecodeError:
-                print("ERROR: Json file {0} decode error!".format(file))
-                quit()
+        # timestamps are compared as strings with the window start, no record is parsed
+        window_start = self._window_start()
+        for _, ticket in self._iter_readable_records('tickets', self._json_tickets_filename_list):
+            update_str = ticket['updated_at']
+
+            # only collects those posts' comments which has been updated in n days
+            if timestamps.is_after(update_str, window_start):
+                if self._known_tickets.get(str(ticket['id'])) == update_str:
+                    # comments did not change since the thread was stored
+                    continue
+                self._tickets_id.append(int(ticket['id']))
+                self._thread_priority[('tickets', str(ticket['id']))] = (
+                    _STATUS_PRIORITY.get(ticket.get('status'), 2), update_str)
+                self._thread_state[('tickets', str(ticket['id']))] = (update_str, None)
 
     def _build_json_tickets_file_list(self):
         """
         build tickets json file list.
         :return: None
         """
-        for root, dirs, files in os.walk(self._save_path):
-            for file in files:
-                if re.match('^ticket[0-9]*.json', file):
-                    self._json_tickets_filename_list.append(os.path.join(self._save_path, file))
+        self._json_tickets_filename_list = self._list_pages('tickets')
 
     @staticmethod
     def _remove_html_tags(raw):
@@ -190,48 +815,433 @@ class AutoZendeskCrawling(object):
         dd = dr.sub('', raw)
         return dd
 
-    def _collect_data_from_api(self, url, file_name):
+    def _collect_data_from_api(self, url, file_name, keep_data=False):
         """
-        open a browser page and collect it.
-        :param js: javascript command to open new browser page
-        :param file_name: file name to save collected data
-        :return: None
+        request an api url through the scheduler and stream the raw response to disk.
+        chunks go to a temporary file which is renamed into place once complete, so a page on disk
+        is never partial. the json is not parsed here, readers validate it when they load it.
+        a failed request is reported and skipped, nothing is saved for it.
+        :param url: api url to request
+        :param file_name: file name to save collected data, a compression suffix is added when compressed
+        :param keep_data: also return the parsed page under key 'data'
+        :return: dict of paging fields (page_count, next_page...) of the page, None if the page is not saved
         """
-        full_path = os.path.join(self._save_path, file_name)
+        if self._manifest is None:
+            return self._collect_records_from_api(url, file_name, keep_data)
+
+        full_path = os.path.join(self._save_path, storage.stored_name(file_name, self._COMPRESSION))
+        tmp_path = full_path + '.part'
+        head = b''
+        tail = b''
         try:
-            if os.path.exists(full_path):
-                os.remove(full_path)
-            file_object = codecs.open(full_path, 'w', 'utf-8')
-            r = requests.get(url, headers=self._header)
-            raw_data = r.json()
-
-            file_object.write(json.dumps(raw_data))
-            file_object.close()
-        except IOError:
-            print("ERROR: IO ERROR when save {0}".format(full_path))
-            quit()
+            # remove this page saved by an earlier run, whatever compression it used
+            storage.remove_stored(os.path.join(self._save_path, file_name))
+            r, cached = self._request_cached(url, stream=True)
+            with r, storage.open_write(tmp_path, self._COMPRESSION) as file_object:
+                for chunk in self._iter_body(url, r, cached):
+                    file_object.write(chunk)
+                    if len(head) < self._FIELD_WINDOW:
+                        head += chunk[:self._FIELD_WINDOW - len(head)]
+                    tail = (tail + chunk)[-self._FIELD_WINDOW:]
+            os.replace(tmp_path, full_path)
+        except ZendeskRequestError as e:
+            print("ERROR: request failed {0}".format(e))
+            return None
+        except requests.RequestException as e:
+            print("ERROR: download of {0} interrupted {1}".format(url, e))
+            self._remove_file(tmp_path)
+            return None
         except OSError:
             print("ERROR: OS ERROR when save {0}".format(full_path))
-            quit()
+            self._remove_file(tmp_path)
+            return None
+        fields = self._extract_page_fields(head, tail, full_path)
+        data = None
+        if fields is not None and (keep_data or self._page_sink is not None):
+            try:
+                data = storage.load_json(full_path)
+            except (OSError, EOFError, ValueError):
+                print("ERROR: can not load {0}".format(full_path))
+                fields = None
+        if fields is None:
+            # not listed in the manifest and not counted as collected, a resumed crawl requests it again
+            self._remove_file(full_path)
+            return None
+        self._manifest.add(full_path)
+        if data is not None:
+            self._emit_page(file_name, data)
+            if keep_data:
+                fields['data'] = data
+        return fields
+
+    def _request_cached(self, url, **kwargs):
+        """
+        request an api url through the scheduler, conditional on the validators of its cached body.
+        :param url: api url to request
+        :param kwargs: extra arguments of requests.Session.get
+        :return: (response, cached body file object), the cached body is None unless the server answered 304
+        """
+        if self._http_cache is None:
+            return self._scheduler.get(url, **kwargs), None
+        r = self._scheduler.get(url, headers=self._http_cache.validators(url), **kwargs)
+        if r.status_code != 304:
+            return r, None
+        cached = self._http_cache.open_body(url)
+        if cached is None:
+            # evicted since the validators were sent, ask for the full body
+            r.close()
+            return self._scheduler.get(url, **kwargs), None
+        return r, cached
+
+    def _iter_body(self, url, r, cached):
+        """
+        chunks of a response body, read from the cached body on 304.
+        a fresh body is also written to the validator cache and stored there once complete.
+        :param url: requested url
+        :param r: streamed requests.Response
+        :param cached: cached body file object from _request_cached
+        :return: generator of bytes
+        """
+        if cached is not None:
+            with cached:
+                for chunk in iter(lambda: cached.read(self._CHUNK_SIZE), b''):
+                    yield chunk
+            return
+        if self._http_cache is None:
+            for chunk in r.iter_content(chunk_size=self._CHUNK_SIZE):
+                self._telemetry.observe_bytes(url, len(chunk))
+                yield chunk
+            return
+
+        cache_path = self._http_cache.temp_file(url)
+        complete = False
+        try:
+            with open(cache_path, 'wb') as cache_object:
+                for chunk in r.iter_content(chunk_size=self._CHUNK_SIZE):
+                    self._telemetry.observe_bytes(url, len(chunk))
+                    cache_object.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if not complete:
+                self._remove_file(cache_path)
+        self._http_cache.put_file(url, r.headers, cache_path)
+
+    def _collect_records_from_api(self, url, file_name, keep_data=False):
+        """
+        request an api url and append its records to the segment store of this run(if any),
+        the page is handed to the page sink as well.
+        :param url: api url to request
+        :param file_name: file name the page would be saved as, gives entity type and parent id of the records
+        :param keep_data: also return the parsed page under key 'data'
+        :return: dict of paging fields (page_count, next_page...) of the page, None if the request failed
+        """
+        entity, parent_id, _ = storage.describe_page(file_name)
+        try:
+            r, cached = self._request_cached(url)
+            if cached is not None:
+                with cached:
+                    data = json.loads(cached.read().decode('utf8'))
+            else:
+                self._telemetry.observe_bytes(url, len(r.content))
+                if self._http_cache is not None:
+                    self._http_cache.put(url, r.headers, r.content)
+                data = r.json()
+        except ZendeskRequestError as e:
+            print("ERROR: request failed {0}".format(e))
+            return None
+        except ValueError:
+            print("ERROR: response of {0} is not json".format(url))
+            return None
+
+        if self._store is not None:
+            self._store.append(entity, storage.page_records(entity, data), parent_id)
+        self._emit_page(file_name, data)
+        fields = {key: data[key] for key in _PAGE_FIELDS if key in data}
+        if keep_data:
+            fields['data'] = data
+        return fields
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _collect_pages_concurrently(self, jobs, collect=None):
+        """
+        collect a batch of pages with a bounded thread pool.
+        each page is saved by _collect_data_from_api as soon as it arrives.
+        :param jobs: list of (url, file_name) tuples
+        :param collect: function called with (url, file_name) for each job, default is _collect_data_from_api
+        :return: None
+        """
+        if not jobs:
+            return
+        collect = collect or self._collect_data_from_api
+        skipped = []
+
+        def collect_in_budget(url, file_name):
+            if self._scheduler.budget_exhausted():
+                skipped.append(file_name)
+                return None
+            return collect(url, file_name)
+
+        with ThreadPoolExecutor(max_workers=self._MAX_WORKERS) as executor:
+            futures = [executor.submit(collect_in_budget, url, file_name) for url, file_name in jobs]
+            for future in as_completed(futures):
+                # re-raise any error of the worker thread in the caller
+                future.result()
+        if skipped:
+            print("request budget exhausted, {0} of {1} jobs skipped".format(len(skipped), len(jobs)))
+
+    def _collect_comment_pages(self, url, file_name):
+        """
+        collect every page of a comment thread by following next_page.
+        the first page is saved as file_name, page n as <file_name without .json>_<n>.json
+        so the DB loader patterns comments_*.json and ticket_comm_*.json still match.
+        :param url: url of the first comments page
+        :param file_name: file name of the first page
+        :return: True if every page of the thread is collected
+        """
+        stage, thread_id, _ = storage.describe_page(file_name)
+        prefix = file_name[:-len('.json')]
+        page_cnt = 1
+        next_page_url = url
+        while next_page_url is not None:
+            if page_cnt > 1:
+                file_name = prefix + '_' + str(page_cnt) + '.json'
+            page = self._collect_data_from_api(next_page_url, file_name)
+            if page is None:
+                return False
+            next_page_url = page.get('next_page')
+            page_cnt += 1
+        self._update_checkpoint(stage, add=('done_ids', thread_id))
+        entity = 'posts' if stage == 'comments' else 'tickets'
+        state = self._thread_state.get((entity, thread_id))
+        if state is not None:
+            # list.append is atomic, the pool threads share this list
+            self._collected_state.append({'id': entity + ':' + thread_id, 'entity': entity, 'thread_id': thread_id,
+                                          'updated_at': state[0], 'comment_count': state[1]})
+        return True
 
+    def _save_thread_state(self):
+        """
+        save the state of the threads fully collected since the last call through the outputs of their comments:
+        a thread_state page in the manifest, the segment store or the page sink.
+        the database records it once the comments are stored, a thread not fully collected keeps its old state
+        and is collected again by the next crawl.
+        :return: None
+        """
+        collected, self._collected_state = self._collected_state, []
+        for entity, stage in (('posts', 'comments'), ('tickets', 'ticket_comments')):
+            records = [record for record in collected if record['entity'] == entity]
+            if not records:
+                continue
+            # done_ids only grows during a run, so every page of the run gets its own name
+            file_name = 'thread_state_{0}_{1}.json'.format(entity, len(self._checkpoint_stage(stage)['done_ids']))
+            data = {'thread_state': records}
+            if self._store is not None:
+                self._store.append('thread_state', records)
+            elif self._manifest is not None:
+                full_path = os.path.join(self._save_path, storage.stored_name(file_name, self._COMPRESSION))
+                try:
+                    with storage.open_write(full_path + '.part', self._COMPRESSION) as file_object:
+                        file_object.write(json.dumps(data).encode('utf8'))
+                    os.replace(full_path + '.part', full_path)
+                except OSError:
+                    print("ERROR: OS ERROR when save {0}".format(full_path))
+                    continue
+                self._manifest.add(full_path)
+            self._emit_page(file_name, data)
 
     def _collect_posts(self):
         """
         collect posts json file(s) from Zendesk API.
         """
-        # collect the first page to get total page count
-        url = 'https://jetadvantage.zendesk.com/api/v2/community/posts.json?page=1'
-        file_name = 'post1.json'
-        self._collect_data_from_api(url, file_name)
+        if self._SEARCH_DISCOVERY and self._collect_posts_search():
+            return
+        if self._DELTA_POSTS:
+            self._collect_posts_delta()
+            return
+
+        progress = self._checkpoint_stage('posts')
+        if 'page_count' not in progress:
+            # collect the first page to get total page count
+            url = self._zendesk_api_entrance + 'community/posts.json?page=1'
+            file_name = 'post1.json'
+            page = self._collect_data_from_api(url, file_name)
+            if page is None or 'page_count' not in page:
+                print("ERROR: can not collect the first posts page, skip posts collection")
+                return
+            self._update_checkpoint('posts', force=True, add=('pages', 1), page_count=page['page_count'])
 
         # find total page count from the first page
-        self._total_page = self._get_page_count()
-        # collect the rest pages
+        self._total_page = progress['page_count']
+        # page count is known now, collect the rest pages concurrently
+        jobs = []
         for page_cnt in range(2, self._total_page + 1):
-            url = 'https://jetadvantage.zendesk.com/api/v2/community/posts.json?page=' + str(
+            if page_cnt in progress['pages']:
+                # collected before the crawl was interrupted
+                continue
+            url = self._zendesk_api_entrance + 'community/posts.json?page=' + str(
                 page_cnt)
             file_name = 'post' + str(page_cnt) + '.json'
-            self._collect_data_from_api(url, file_name)
+            jobs.append((url, file_name))
+        self._collect_pages_concurrently(jobs, collect=self._collect_posts_page)
+
+    def _collect_posts_page(self, url, file_name):
+        """
+        collect one posts page and record it in the checkpoint.
+        :param url: url of the posts page
+        :param file_name: file name of the page
+        :return: dict of paging fields, None if the page is not collected
+        """
+        page = self._collect_data_from_api(url, file_name)
+        if page is not None:
+            self._update_checkpoint('posts', add=('pages', storage.describe_page(file_name)[2]))
+        return page
+
+    def _collect_posts_delta(self):
+        """
+        collect only the posts pages inside the collection window.
+        posts are requested sorted by updated_at descending, pagination stops after the first page
+        whose posts are all older than self._LATEST_DAYS_DATA_TO_COLLECT days.
+        the pages replace post1.json..postN.json, pages of an earlier crawl are kept as they are:
+        the DB loader reads only the pages in the manifest of the latest run, and the database keeps
+        every post not in the window.
+        :return: None
+        """
+        cutoff = self._window_start()
+        page_cnt = 1
+        next_page_url = self._zendesk_api_entrance + 'community/posts.json?sort_by=updated_at&page=1'
+        while next_page_url is not None:
+            file_name = 'post' + str(page_cnt) + '.json'
+            # the post dates are needed here, so this page is fully parsed
+            page = self._collect_data_from_api(next_page_url, file_name, keep_data=True)
+            if page is None:
+                break
+
+            next_page_url = page.get('next_page')
+            # timestamps have a fixed format, string order is time order
+            if all(post['updated_at'] < cutoff for post in page['data']['posts']):
+                break
+            page_cnt += 1
+
+        print("collected {0} posts page(s) in delta mode".format(page_cnt))
+
+    def _window_start(self):
+        """
+        start of the collection window, computed at its first use in a run so every record of the run
+        is checked against the same start.
+        :return: Zendesk timestamp self._LATEST_DAYS_DATA_TO_COLLECT days ago
+        """
+        if self._window is None:
+            self._window = timestamps.window_start(self._LATEST_DAYS_DATA_TO_COLLECT)
+        return self._window
+
+    def _search_url(self, entity, since):
+        """
+        url of the search of the posts or tickets updated after since, results sorted by updated_at ascending.
+        :param entity: 'posts' or 'tickets'
+        :param since: Zendesk timestamp eg. 2018-01-18T14:06:16Z
+        :return: url of the first results page
+        """
+        if entity == 'posts':
+            # https://jetadvantage.zendesk.com/api/v2/help_center/community_posts/search.json?updated_after=2018-01-18
+            # the help center search filters by day and needs a query
+            path = 'help_center/community_posts/search.json'
+            params = [('query', '*'), ('updated_after', since[:10])]
+        else:
+            # https://jetadvantage.zendesk.com/api/v2/search.json?query=type:ticket updated>2018-01-18T14:06:16Z
+            path = 'search.json'
+            params = [('query', 'type:ticket updated>' + since)]
+        params += [('sort_by', 'updated_at'), ('sort_order', 'asc')]
+        return self._zendesk_api_entrance + path + '?' + urllib.parse.urlencode(params)
+
+    def _collect_search(self, entity):
+        """
+        save the search results pages of the posts or tickets updated in the collection window.
+        search results are full records, so nothing else is requested for them.
+        a search returns at most self._SEARCH_RESULT_LIMIT results, once they are read the search starts again
+        from the last updated_at seen, one second earlier so no record updated in that second is missed.
+        pages are named post_search_<n>.json or ticket_search_<n>.json, n counts the pages of the whole search.
+        :param entity: 'posts' or 'tickets'
+        :return: number of search results read, None if the search failed
+        """
+        prefix = 'post_search_' if entity == 'posts' else 'ticket_search_'
+        since = self._window_start()
+        page_cnt = 0
+        found = 0
+        last_url = None
+        while True:
+            url = self._search_url(entity, since)
+            if url == last_url:
+                # the search can not go past the records updated at since
+                print("ERROR: more than {0} {1} updated at {2} found by search".format(
+                    self._SEARCH_RESULT_LIMIT, entity, since))
+                return None
+            last_url = url
+            next_page_url = url
+            results = 0
+            while next_page_url is not None and results < self._SEARCH_RESULT_LIMIT:
+                page_cnt += 1
+                page = self._collect_data_from_api(next_page_url, prefix + str(page_cnt) + '.json', keep_data=True)
+                if page is None:
+                    return None
+                records = page['data'].get('results', [])
+                results += len(records)
+                if records:
+                    since = records[-1]['updated_at']
+                next_page_url = page.get('next_page')
+            found += results
+            if results < self._SEARCH_RESULT_LIMIT:
+                return found
+            since = timestamps.format_timestamp(timestamps.to_epoch(since) - 1)
+
+    def _record_jobs(self, post_ids=(), ticket_ids=()):
+        """
+        jobs requesting posts one by one and tickets 100 at a time with tickets/show_many,
+        pages are named post_show_<id>.json and ticket_show_<first id>.json apart from the pages of a crawl.
+        :param post_ids: ids of the posts
+        :param ticket_ids: ids of the tickets
+        :return: dict of (url, file_name) to the list of ('posts'|'tickets', id) the page holds
+        """
+        # https://jetadvantage.zendesk.com/api/v2/community/posts/220794928.json
+        jobs = dict(((self._zendesk_api_entrance + 'community/posts/' + str(id0) + '.json',
+                      'post_show_' + str(id0) + '.json'), [('posts', str(id0))]) for id0 in post_ids)
+        # https://jetadvantage.zendesk.com/api/v2/tickets/show_many.json?ids=1,2,3
+        ticket_ids = [str(id0) for id0 in ticket_ids]
+        for start in range(0, len(ticket_ids), self._SHOW_MANY_BATCH_SIZE):
+            batch = ticket_ids[start:start + self._SHOW_MANY_BATCH_SIZE]
+            jobs[(self._zendesk_api_entrance + 'tickets/show_many.json?ids=' + ','.join(batch),
+                  'ticket_show_' + batch[0] + '.json')] = [('tickets', id0) for id0 in batch]
+        return jobs
+
+    def _collect_posts_search(self):
+        """
+        collect only the posts updated in the collection window, found with the search api.
+        :return: False if the search failed and the posts must be listed
+        """
+        found = self._collect_search('posts')
+        if found is None:
+            print("ERROR: posts search failed, list the posts instead")
+            return False
+        print("collected {0} posts found by search".format(found))
+        return True
+
+    def _collect_tickets_search(self):
+        """
+        collect only the tickets updated in the collection window, found with the search api.
+        :return: False if the search failed and the tickets must be listed
+        """
+        found = self._collect_search('tickets')
+        if found is None:
+            print("ERROR: tickets search failed, list the tickets instead")
+            return False
+        print("collected {0} tickets found by search".format(found))
+        return True
 
     def _collect_comments(self):
         """
@@ -239,39 +1249,118 @@ class AutoZendeskCrawling(object):
         Only collect comments belong to post updated/created in recent particular days.
         :return: None
         """
-        # TODO : now I consider all comments only have one page, should detect page count
+        self._collect_pages_concurrently(self._by_priority(self._post_thread_jobs()),
+                                         collect=self._collect_comment_pages)
+        self._save_thread_state()
+
+    def _post_thread_jobs(self):
+        """
+        jobs of the post comment threads to collect.
+        :return: list of (priority, url, file_name)
+        """
         # comments query format
         # https://jetadvantage.zendesk.com/api/v2/community/posts/220794928/comments.json
         self._build_json_posts_file_list()
         self._parse_json_posts_file()
-        for id0 in self._posts_id:
-            url = 'https://jetadvantage.zendesk.com/api/v2/community/posts/' + id0 + '/comments.json'
+        done_ids = self._checkpoint_stage('comments')['done_ids']
+        jobs = []
+        for id0 in map(str, self._posts_id):
+            if id0 in done_ids:
+                # collected before the crawl was interrupted
+                continue
+            url = self._zendesk_api_entrance + 'community/posts/' + id0 + '/comments.json'
             file_name = 'comments_' + id0 + '.json'
-            self._collect_data_from_api(url, file_name)
+            jobs.append((self._thread_priority.get(('posts', id0), (2, '')), url, file_name))
+        return jobs
+
+    @staticmethod
+    def _by_priority(jobs):
+        """
+        order comment thread jobs open first, then latest updated first.
+        the pool takes jobs in submission order, so this is the order the threads are fetched in.
+        :param jobs: list of ((status rank, updated_at), url, file_name)
+        :return: list of (url, file_name)
+        """
+        jobs = sorted(jobs, key=lambda job: job[0][1], reverse=True)
+        jobs.sort(key=lambda job: job[0][0])
+        return [(url, file_name) for _, url, file_name in jobs]
+
+    def _collect_threads(self):
+        """
+        collect the comment threads of posts and tickets from one queue ordered by _by_priority,
+        used instead of the comments and ticket_comments stages when the run has a request budget.
+        :return: None
+        """
+        self._collect_pages_concurrently(self._by_priority(self._post_thread_jobs() + self._ticket_thread_jobs()),
+                                         collect=self._collect_comment_pages)
+        self._save_thread_state()
 
     def _collect_tickets(self):
         """
         collect posts json file(s) from Zendesk API.
         :return:
         """
-        page_cnt = 1
-        next_page_url = 'https://jetadvantage.zendesk.com/api/v2/tickets.json?page=' + str(
-            page_cnt)
+        if self._SEARCH_DISCOVERY and self._collect_tickets_search():
+            return
+        if self._INCREMENTAL:
+            self._collect_tickets_incremental()
+            return
+
+        progress = self._checkpoint_stage('tickets')
+        page_cnt = progress.get('page', 1)
+        next_page_url = progress.get('next_page', self._zendesk_api_entrance + 'tickets.json?page=' + str(
+            page_cnt))
 
         while next_page_url is not None:
             file_name = 'ticket' + str(page_cnt) + '.json'
-            self._collect_data_from_api(next_page_url, file_name)
-            try:
-                with open(os.path.join(self._save_path, file_name), 'r', encoding='utf8') as f:
-                    data = json.load(f)
-                    next_page_url = data['next_page']
-            except IOError:
-                print("ERROR: IO ERROR when load {0}".format(file_name))
-                quit()
-            except json.JSONDecodeError:
-                print("ERROR: Json file {0} decode error!".format(file_name))
-                quit()
+            page = self._collect_data_from_api(next_page_url, file_name)
+            if page is None:
+                # keep the pages collected so far
+                break
+            next_page_url = page.get('next_page')
+            page_cnt += 1
+            self._update_checkpoint('tickets', force=True, page=page_cnt, next_page=next_page_url)
+
+    def _collect_tickets_incremental(self):
+        """
+        collect only the tickets changed since the last sync with the incremental ticket export api.
+        pages are saved as ticket<n>.json like the full crawl, the cursor is saved after every page
+        so the next run starts right after the last collected page.
+        the first run (no saved cursor) exports all tickets once.
+        :return: None
+        """
+        # incremental export query format
+        # https://jetadvantage.zendesk.com/api/v2/incremental/tickets/cursor.json?start_time=0
+        state = self._load_state_file(self._sync_state_file)
+        ticket_state = state.get('tickets', {})
+        cursor = ticket_state.get('after_cursor')
+        if cursor:
+            next_page_url = self._zendesk_api_entrance + 'incremental/tickets/cursor.json?cursor=' + cursor
+        else:
+            next_page_url = self._zendesk_api_entrance + 'incremental/tickets/cursor.json?start_time=' + str(
+                ticket_state.get('start_time', 0))
+
+        # a resumed crawl continues the page numbering so no page of this run is overwritten
+        progress = self._checkpoint_stage('tickets')
+        page_cnt = progress.get('page', 1)
+        next_page_url = progress.get('next_page', next_page_url)
+        while next_page_url is not None:
+            file_name = 'ticket' + str(page_cnt) + '.json'
+            page = self._collect_data_from_api(next_page_url, file_name)
+            if page is None:
+                # the saved cursor still points to the last collected page
+                break
+
+            if page.get('after_cursor'):
+                state['tickets'] = {'after_cursor': page['after_cursor'], 'synced_at': int(time.time())}
+                self._save_state_file(self._sync_state_file, state)
+
+            if page.get('end_of_stream', True):
+                next_page_url = None
+            else:
+                next_page_url = page.get('after_url')
             page_cnt += 1
+            self._update_checkpoint('tickets', force=True, page=page_cnt, next_page=next_page_url)
 
     def _collect_ticket_comments(self):
         """
@@ -279,15 +1368,54 @@ class AutoZendeskCrawling(object):
         Only collect comments belong to post updated/created in recent particular days.
         :return: None
         """
-        # TODO : now I consider all comments only have one page, should detect page count
+        self._collect_pages_concurrently(self._by_priority(self._ticket_thread_jobs()),
+                                         collect=self._collect_comment_pages)
+        self._save_thread_state()
+
+    def _ticket_thread_jobs(self):
+        """
+        jobs of the ticket comment threads to collect.
+        :return: list of (priority, url, file_name)
+        """
         # comments query format
-        # https://jetadvantage.zendesk.com/api/v2/community/posts/220794928/comments.json
+        # https://jetadvantage.zendesk.com/api/v2/tickets/220794928/comments.json
         self._build_json_tickets_file_list()
         self._parse_json_tickets_file()
-        for id0 in self._tickets_id:
-            url = 'https://jetadvantage.zendesk.com/api/v2/tickets/' + id0 + '/comments.json'
+        done_ids = self._checkpoint_stage('ticket_comments')['done_ids']
+        jobs = []
+        for id0 in map(str, self._tickets_id):
+            if id0 in done_ids:
+                # collected before the crawl was interrupted
+                continue
+            url = self._zendesk_api_entrance + 'tickets/' + id0 + '/comments.json'
             file_name = 'ticket_comm_' + id0 + '.json'
-            self._collect_data_from_api(url, file_name)
+            jobs.append((self._thread_priority.get(('tickets', id0), (2, '')), url, file_name))
+        return jobs
+
+    def _collect_referenced_users(self):
+        """
+        collect the users referenced by the collected posts, comments and tickets,
+        users already stored in database are skipped, the rest are fetched 100 at a time with users/show_many.
+        much cheaper than the full users crawl of _collect_users.
+        :return: None
+        """
+        user_ids = set()
+        for entity in ('posts', 'comments', 'tickets', 'ticket_comments'):
+            for _, record in self._iter_records(entity, self._list_pages(entity)):
+                for field in _USER_ID_FIELDS:
+                    if record.get(field) is not None:
+                        user_ids.add(str(record[field]))
+        user_ids = sorted(user_ids - self._known_users, key=int)
+        print("collecting {0} users".format(len(user_ids)))
+
+        # https://jetadvantage.zendesk.com/api/v2/users/show_many.json?ids=1,2,3
+        jobs = []
+        for start in range(0, len(user_ids), self._SHOW_MANY_BATCH_SIZE):
+            batch = user_ids[start:start + self._SHOW_MANY_BATCH_SIZE]
+            url = self._zendesk_api_entrance + 'users/show_many.json?ids=' + ','.join(batch)
+            file_name = 'users_' + str(len(jobs) + 1) + '.json'
+            jobs.append((url, file_name))
+        self._collect_pages_concurrently(jobs)
 
     def _collect_users(self):
         """
@@ -297,20 +1425,14 @@ class AutoZendeskCrawling(object):
         # print("Collecting Users...")
         # https://jetadvantage.zendesk.com/api/v2/users.json
         page_cnt = 1
-        next_page_url = 'https://jetadvantage.zendesk.com/api/v2/users.json'
+        next_page_url = self._zendesk_api_entrance + 'users.json'
         while next_page_url is not None:
             file_name = 'users_' + str(page_cnt) + '.json'
-            self._collect_data_from_api(next_page_url, file_name)
-            try:
-                with open(os.path.join(self._save_path, file_name), 'r', encoding='utf8') as f:
-                    data = json.load(f)
-                    next_page_url = data['next_page']
-            except IOError:
-                print("ERROR: IO ERROR when load {0}".format(file_name))
-                quit()
-            except json.JSONDecodeError:
-                print("ERROR: Json file {0} decode error!".format(file_name))
-                quit()
+            page = self._collect_data_from_api(next_page_url, file_name)
+            if page is None:
+                # keep the pages collected so far
+                break
+            next_page_url = page.get('next_page')
             page_cnt += 1
 
     def _collect_topics(self):
@@ -320,21 +1442,233 @@ class AutoZendeskCrawling(object):
         """
         # print("Collecting Topics...")
         # https://jetadvantage.zendesk.com/api/v2/community/topics.json
-        url = 'https://jetadvantage.zendesk.com/api/v2/community/topics.json'
+        url = self._zendesk_api_entrance + 'community/topics.json'
         file_name = 'topics.json'
         self._collect_data_from_api(url, file_name)
 
     def collect_users(self):
         self._collect_users()
 
+    def _begin_sync_call(self):
+        """
+        start a call of the sync services(sync_changes, refetch, collect_comment_threads), which reuse one crawler
+        so its scheduler(rate limit, Retry-After pause) and keep-alive connections last between calls.
+        nothing is saved in the checkpoint, the stage progress and the records observed by earlier calls
+        are dropped and the collection window is computed again.
+        :return: None
+        """
+        self._checkpointing = False
+        self._window = None
+        with self._checkpoint_lock:
+            # a finished listing leaves next_page=None, the next call would request no page
+            self._checkpoint['stages'] = dict()
+        with self._observed_lock:
+            for records in self._observed.values():
+                del records[:]
+
+    def sync_changes(self):
+        """
+        collect the posts and tickets changed lately, used by the sync daemon:
+        posts pages sorted by updated_at down to the collection window and the incremental tickets export
+        from the saved cursor, or the search of both with search_discovery.
+        pages go to the outputs and the page sink, nothing is saved in the checkpoint.
+        :return: None
+        """
+        self._begin_sync_call()
+        if not (self._SEARCH_DISCOVERY and self._collect_posts_search()):
+            self._collect_posts_delta()
+        if not (self._SEARCH_DISCOVERY and self._collect_tickets_search()):
+            self._collect_tickets_incremental()
+
+    def refetch(self, post_ids=(), ticket_ids=()):
+        """
+        collect again the given posts and tickets with their comment threads, used by the webhook receiver.
+        pages are named after the post or ticket id, see _record_jobs.
+        :param post_ids: ids of the posts
+        :param ticket_ids: ids of the tickets
+        :return: list of ('posts'|'tickets', id) collected and stored with their whole comment thread
+        """
+        self._begin_sync_call()
+        jobs = self._record_jobs(post_ids=post_ids, ticket_ids=ticket_ids)
+        fetched = set()
+
+        def collect_records(url, file_name):
+            try:
+                if self._collect_data_from_api(url, file_name) is not None:
+                    fetched.update(jobs[(url, file_name)])
+            except Exception as e:
+                print("ERROR: page {0} not collected: {1}".format(file_name, e))
+
+        self._collect_pages_concurrently(list(jobs), collect=collect_records)
+        return [thread for thread in self.collect_comment_threads(post_ids=post_ids, ticket_ids=ticket_ids)
+                if thread in fetched]
+
+    def collect_comment_threads(self, post_ids=(), ticket_ids=()):
+        """
+        collect the comment threads of the given posts and tickets, used by the sync services.
+        threads are fetched in the given order, posts first, nothing is saved in the checkpoint.
+        a thread is not collected if a page request failed or the page sink raised an error for one of its pages.
+        :param post_ids: ids of the posts
+        :param ticket_ids: ids of the tickets
+        :return: list of ('posts'|'tickets', id) of the threads whose every page is collected
+        """
+        self._begin_sync_call()
+        threads = [('posts', str(id0)) for id0 in post_ids] + [('tickets', str(id0)) for id0 in ticket_ids]
+        jobs = dict((self._comment_thread_job(entity, id0), (entity, id0)) for entity, id0 in threads)
+        collected = []
+
+        def collect_thread(url, file_name):
+            try:
+                if self._collect_comment_pages(url, file_name):
+                    # list.append is atomic, the pool threads share this list
+                    collected.append(jobs[(url, file_name)])
+            except Exception as e:
+                print("ERROR: comment thread {0} not collected: {1}".format(file_name, e))
+
+        self._collect_pages_concurrently(list(jobs), collect=collect_thread)
+        return collected
+
+    def _comment_thread_job(self, entity, id0):
+        """
+        :param entity: 'posts' or 'tickets'
+        :param id0: id of the post or ticket
+        :return: (url, file_name) of the first page of its comment thread
+        """
+        if entity == 'posts':
+            return (self._zendesk_api_entrance + 'community/posts/' + str(id0) + '/comments.json',
+                    'comments_' + str(id0) + '.json')
+        return (self._zendesk_api_entrance + 'tickets/' + str(id0) + '/comments.json',
+                'ticket_comm_' + str(id0) + '.json')
+
+    def publish_thread_jobs(self, db):
+        """
+        queue the comment threads to collect in the job table of db instead of collecting them,
+        crawler workers on any machine claim them from there(auto_zendesk_thread_jobs.AutoZendeskThreadWorker).
+        run after the posts and tickets are listed, eg. after sync_changes(). threads unchanged since they were
+        last collected and stored are skipped when the crawler has a db, a thread marked done by a worker
+        has its state recorded.
+        :param db: AutoZendeskDB holding the job table
+        :return: number of threads queued
+        """
+        self._load_thread_state()
+        self._posts_id = timestamps.id_array()
+        self._tickets_id = timestamps.id_array()
+        self._thread_priority = dict()
+        self._thread_state = dict()
+        self._build_json_posts_file_list()
+        self._parse_json_posts_file()
+        self._build_json_tickets_file_list()
+        self._parse_json_tickets_file()
+        jobs = []
+        for entity, ids in (('posts', self._posts_id), ('tickets', self._tickets_id)):
+            for id0 in map(str, ids):
+                jobs.append((entity, id0) + self._thread_priority[(entity, id0)] +
+                            self._thread_state[(entity, id0)][1:])
+        db.enqueue_thread_jobs(jobs)
+        print("queued {0} post and {1} ticket comment threads".format(len(self._posts_id), len(self._tickets_id)))
+        return len(jobs)
+
 
     def run_all(self):
-        self._collect_posts()
-        self._collect_comments()
-        # self._collect_users()
-        self._collect_topics()
-        self._collect_tickets()
-        self._collect_ticket_comments()
+        if self._instances:
+            self._run_instances('run_all')
+            return
+        self._new_checkpoint()
+        self._run_stages()
+
+    def _run_instances(self, method):
+        """
+        run the crawler of every instance concurrently, each in its own thread.
+        :param method: name of the crawler method to run, 'run_all' or 'resume'
+        :return: None
+        """
+        threads = [threading.Thread(target=getattr(crawler, method), name='crawl-' + crawler._subdomain)
+                   for crawler in self._instances]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self._print_connection_stats()
+
+    def resume(self):
+        """
+        continue the crawl interrupted by a crash from its checkpoint:
+        finished stages are skipped, posts pages and comment threads already collected are not requested again
+        and the tickets crawl goes on from its saved next_page.
+        :return: None
+        """
+        if self._instances:
+            self._run_instances('resume')
+            return
+        checkpoint = self._load_state_file(self._checkpoint_file)
+        if not checkpoint or checkpoint.get('finished'):
+            print("no interrupted crawl to resume, start a new crawl")
+            self.run_all()
+            return
+        if self._OUTPUT is None:
+            # posts and tickets were only kept in memory by the interrupted crawl
+            print("ERROR: a crawl without output can not be resumed, start a new crawl")
+            self.run_all()
+            return
+
+        print("resume crawl {0}".format(checkpoint['run_id']))
+        self._open_run(checkpoint['run_id'])
+        # the saved lists become sets once, stages add to them in place
+        for progress in checkpoint['stages'].values():
+            for key in ('pages', 'done_ids'):
+                progress[key] = set(progress.get(key, []))
+        with self._checkpoint_lock:
+            self._checkpoint = checkpoint
+            self._checkpoint_saved_at = time.time()
+        self._run_stages()
+
+    def _run_stages(self):
+        """
+        run every crawl stage not finished yet, each finished stage is recorded in the checkpoint.
+        :return: None
+        """
+        self._window = None
+        self._load_thread_state()
+        if self._REQUEST_BUDGET is None:
+            stages = (('posts', self._collect_posts),
+                      ('comments', self._collect_comments),
+                      ('topics', self._collect_topics),
+                      ('tickets', self._collect_tickets),
+                      ('ticket_comments', self._collect_ticket_comments),
+                      ('users', self._collect_referenced_users))
+        else:
+            # both thread lists are known before any comment is fetched, the freshest threads go first
+            stages = (('posts', self._collect_posts),
+                      ('tickets', self._collect_tickets),
+                      ('threads', self._collect_threads),
+                      ('topics', self._collect_topics),
+                      ('users', self._collect_referenced_users))
+        finished = True
+        for stage, collect in stages:
+            if self._checkpoint_stage(stage).get('done'):
+                continue
+            started = time.monotonic()
+            collect()
+            self._telemetry.observe_stage(stage, time.monotonic() - started)
+            if self._scheduler.budget_exhausted():
+                # the stage may be cut short, resume() continues it with the budget of the next run
+                print("request budget exhausted in stage {0}".format(stage))
+                finished = False
+                break
+            self._update_checkpoint(stage, force=True, done=True)
+
+        if self._store is not None:
+            self._store.close()
+        if self._http_cache is not None:
+            self._http_cache.save()
+        try:
+            print("metrics written to {0}".format(self._telemetry.write(self._save_path, self._run_id)))
+        except OSError:
+            print("ERROR: OS ERROR when write metrics of run {0}".format(self._run_id))
+        with self._checkpoint_lock:
+            self._checkpoint['finished'] = finished
+            self._save_state_file(self._checkpoint_file, self._checkpoint)
+        self._print_connection_stats()
 
     def test(self):
         # self._collect_posts()
@@ -45,10 +45,12 @@ import re
 import psycopg2
 import psycopg2.extras
 import configure
+import auto_zendesk_storage as storage
 
 
 class AutoZendeskDB(object):
-    def __init__(self, postgresql_dbname, postgresql_user, postgresql_passwd, postgresql_host, postgresql_port):
+    def __init__(self, postgresql_dbname, postgresql_user, postgresql_passwd, postgresql_host, postgresql_port,
+                 source='files', instance=None):
         """
         initial method
         :param postgresql_dbname: database name
@@ -56,8 +58,28 @@ class AutoZendeskDB(object):
         :param postgresql_passwd: passwd for the user
         :param postgresql_host: database host
         :param postgresql_port: database port
+        :param source: 'files' loads the saved json pages, 'segments' loads the segment store of the latest crawl run
+        :param instance: subdomain of the Zendesk instance when several instances are crawled,
+                         its crawl is loaded from OUTPUT_PATH/<instance> and its tables live in schema <instance>
         """
+        self._instance = instance
         self._save_path = configure.OUTPUT_PATH
+        if instance is not None:
+            if not re.match(r'^[a-z0-9][a-z0-9-]*$', instance):
+                raise ValueError("invalid Zendesk subdomain {0}".format(instance))
+            self._save_path = os.path.join(self._save_path, instance)
+
+        self._store = None
+        # pages of the latest crawl run are listed in its manifest, the output path is only walked without one
+        self._manifest = None
+        if source == 'files':
+            self._manifest = storage.CrawlManifest.latest(self._save_path)
+        elif source == 'segments':
+            run_id = storage.RecordStore.latest_run_id(self._save_path)
+            if run_id is None:
+                print("ERROR: no segment store found in {0}".format(self._save_path))
+                quit()
+            self._store = storage.RecordStore(self._save_path, run_id)
 
         # length limit of a excel cell
         self._EXCEL_MAXIMUM_CELL = 32767
@@ -77,6 +99,14 @@ class AutoZendeskDB(object):
         self._json_tickets_filename_list = []
         self._json_tickets_comments_filename_list = []
 
+        # json tables of each entity type: (table, parent id column)
+        self._JSON_TABLES = {
+            'posts': ('isv_posts_json', None),
+            'comments': ('isv_comments_json', 'post_id'),
+            'tickets': ('isv_tickets_json', None),
+            'ticket_comments': ('isv_tcomments_json', 'ticket_id'),
+        }
+
         self._connect_postgresql()
 
     def __del__(self):
@@ -96,6 +126,12 @@ class AutoZendeskDB(object):
         print("Connected to {host}:{port}  {db}".format(host=self._postgresql_host,
                                                         port=self._postgresql_port,
                                                         db=self._postgresql_dbname))
+        if self._instance is not None:
+            # every table of the instance is created and read in its own schema
+            cur = self._postgresql_conn.cursor()
+            cur.execute('CREATE SCHEMA IF NOT EXISTS "{0}";'.format(self._instance))
+            cur.execute('SET search_path TO "{0}";'.format(self._instance))
+            self._postgresql_conn.commit()
 
     def _disconnect_postgresql(self):
         """
@@ -119,6 +155,61 @@ class AutoZendeskDB(object):
         self._postgresql_conn.commit()
         cur.close()
 
+    def upsert_json_records(self, entity, items):
+        """
+        insert or update a batch of collected records in one statement, used by the crawler to database pipeline.
+        posts, comments, tickets and ticket comments go to their *_json tables,
+        topics and users are written to isv_topics and isv_users directly, thread state to isv_thread_state.
+        :param entity: entity type eg. 'posts'
+        :param items: list of (parent id, record), parent id is the post or ticket id of comments
+        :return: None
+        """
+        try:
+            self._upsert_json_records(entity, items)
+        except Exception:
+            # leave the connection usable for the next batch, the caller decides what to do with this one
+            self._postgresql_conn.rollback()
+            raise
+
+    def _upsert_json_records(self, entity, items):
+        if entity == 'thread_state':
+            self._save_thread_state([record for _, record in items])
+            return
+        if entity == 'topics':
+            self._build_topics_postgresql([record for _, record in items])
+            return
+        if entity == 'users':
+            self._build_users_postgresql([record for _, record in items])
+            return
+
+        table, parent_column = self._JSON_TABLES[entity]
+        # the same record can come twice (pages shift while crawling), the last copy wins
+        rows = dict()
+        for parent_id, record in items:
+            if entity == 'comments':
+                parent_id = record['post_id']
+            if parent_column:
+                rows[str(record['id'])] = (str(record['id']), str(parent_id), psycopg2.extras.Json(record))
+            else:
+                rows[str(record['id'])] = (str(record['id']), psycopg2.extras.Json(record))
+        if not rows:
+            return
+
+        cur = self._postgresql_conn.cursor()
+        if parent_column:
+            cur.execute("CREATE TABLE IF NOT EXISTS {0} (id VARCHAR PRIMARY KEY, {1} VARCHAR, jdoc jsonb);"
+                        .format(table, parent_column))
+            command = ("INSERT INTO {0} (id, {1}, jdoc) VALUES %s "
+                       "ON CONFLICT (id) DO UPDATE SET jdoc = EXCLUDED.jdoc;".format(table, parent_column))
+        else:
+            cur.execute("CREATE TABLE IF NOT EXISTS {0} (id VARCHAR PRIMARY KEY, jdoc jsonb);".format(table))
+            command = "INSERT INTO {0} (id, jdoc) VALUES %s ON CONFLICT (id) DO UPDATE SET jdoc = EXCLUDED.jdoc;"\
+                .format(table)
+        # rows are written in id order so concurrent writers lock them in the same order
+        psycopg2.extras.execute_values(cur, command, [rows[key] for key in sorted(rows)])
+        self._postgresql_conn.commit()
+        cur.close()
+
     def _initial_posts_postgresql(self):
         """
         build post json table
@@ -130,53 +221,71 @@ class AutoZendeskDB(object):
         cur = self._postgresql_conn.cursor()
         cur.execute("CREATE TABLE IF NOT EXISTS isv_posts_json (id VARCHAR PRIMARY KEY, jdoc jsonb);")
 
-        for filename in self._json_posts_filename_list:
-            data = self._load_json(filename)
-            posts = data['posts']
-            for post in posts:
-                cur.execute("SELECT * FROM isv_posts_json WHERE id = %s;", (str(post['id']),))
-                result = cur.fetchall()
-                if result:
-                    command = "UPDATE isv_posts_json SET jdoc = %s WHERE id = %s;"
-                    cur.execute(command, [psycopg2.extras.Json(post), str(post['id'])])
-                else:
-                    cur.execute("INSERT INTO isv_posts_json (id, jdoc) VALUES(%s, %s);",
-                                [str(post['id']), psycopg2.extras.Json(post)])
+        for _, post in self._iter_records('posts', self._json_posts_filename_list):
+            cur.execute("SELECT * FROM isv_posts_json WHERE id = %s;", (str(post['id']),))
+            result = cur.fetchall()
+            if result:
+                command = "UPDATE isv_posts_json SET jdoc = %s WHERE id = %s;"
+                cur.execute(command, [psycopg2.extras.Json(post), str(post['id'])])
+            else:
+                cur.execute("INSERT INTO isv_posts_json (id, jdoc) VALUES(%s, %s);",
+                            [str(post['id']), psycopg2.extras.Json(post)])
 
         self._postgresql_conn.commit()
         cur.close()
         print("table isv_posts_json updated")
 
     def _parse_json_posts_file(self):
-        for file in self._json_posts_filename_list:
+        for _, post in self._iter_records('posts', self._json_posts_filename_list):
+            self._posts_id.append(str(post['id']))
+
+    def _list_pages(self, entity):
+        """
+        list the saved pages of one entity type, from the manifest of the latest crawl run when there is one.
+        :param entity: entity type eg. 'posts'
+        :return: list of page paths
+        """
+        if self._manifest is None:
+            return storage.scan_pages(self._save_path, entity)
+        pages = []
+        for path in self._manifest.files(entity):
+            if os.path.exists(path):
+                pages.append(path)
+            else:
+                print("ERROR: {0} listed in the manifest is missing".format(path))
+        return pages
+
+    def _iter_records(self, entity, file_names):
+        """
+        stream the collected records of one entity type, from the segment store of the latest run
+        or from the saved pages.
+        :param entity: entity type eg. 'posts'
+        :param file_names: saved pages of the entity, not used with the segment store
+        :return: generator of (parent id, record)
+        """
+        if self._store is not None:
+            for item in self._store.iter_records(entity):
+                yield item
+            return
+
+        for filename in file_names:
             try:
-                with open(file, 'r', encoding='utf8') as f:
-                    data = json.load(f)
-                    posts = data['posts']
-                    for post in posts:
-                        self._posts_id.append(str(post['id']))
-
-            except json.JSONDecodeError:
-                print("ERROR: Json file {0} decode error!".format(file))
+                data = self._load_json(filename)
+            except IOError:
+                print("ERROR: IO ERROR when load {0}".format(filename))
                 quit()
+            parent_id = storage.describe_page(filename)[1]
+            for record in storage.page_records(entity, data):
+                yield parent_id, record
 
     def _build_json_posts_file_list(self):
-        for root, dirs, files in os.walk(self._save_path):
-            for file in files:
-                if re.match('^post.*.json', file):
-                    self._json_posts_filename_list.append(os.path.join(self._save_path, file))
+        self._json_posts_filename_list = self._list_pages('posts')
 
     def _build_json_users_file_list(self):
-        for root, dirs, files in os.walk(self._save_path):
-            for file in files:
-                if re.match('^users.*.json', file):
-                    self._json_users_filename_list.append(os.path.join(self._save_path, file))
+        self._json_users_filename_list = self._list_pages('users')
 
     def _build_json_comments_file_list(self):
-        for root, dirs, files in os.walk(self._save_path):
-            for file in files:
-                if re.match('^comment.*.json', file):
-                    self._json_comments_filename_list.append(os.path.join(self._save_path, file))
+        self._json_comments_filename_list = self._list_pages('comments')
 
     def _initial_comments_postgresql(self):
         """
@@ -193,28 +302,26 @@ class AutoZendeskDB(object):
                     jdoc jsonb);
                     """)
 
-        for filename in self._json_comments_filename_list:
-            data = self._load_json(filename)
-            comments = data['comments']
-            for comment in comments:
-                cur.execute("SELECT * FROM isv_comments_json WHERE id=%s;", (str(comment['id']),))
-                result = cur.fetchall()
-                if result:
-                    command = "UPDATE isv_comments_json SET jdoc = %s WHERE id = %s;"
-                    cur.execute(command, [psycopg2.extras.Json(comment), str(comment['id'])])
-                else:
-                    command = "INSERT INTO isv_comments_json (id, post_id, jdoc) VALUES(%s, %s, %s);"
-                    cur.execute(command, [str(comment['id']), str(comment['post_id']), psycopg2.extras.Json(comment)])
+        for _, comment in self._iter_records('comments', self._json_comments_filename_list):
+            cur.execute("SELECT * FROM isv_comments_json WHERE id=%s;", (str(comment['id']),))
+            result = cur.fetchall()
+            if result:
+                command = "UPDATE isv_comments_json SET jdoc = %s WHERE id = %s;"
+                cur.execute(command, [psycopg2.extras.Json(comment), str(comment['id'])])
+            else:
+                command = "INSERT INTO isv_comments_json (id, post_id, jdoc) VALUES(%s, %s, %s);"
+                cur.execute(command, [str(comment['id']), str(comment['post_id']), psycopg2.extras.Json(comment)])
 
         self._postgresql_conn.commit()
         cur.close()
 
         print("table isv_comments_json updated")
 
-    def _build_topics_postgresql(self):
+    def _build_topics_postgresql(self, topics=None):
 
         """
         build isv_topics table in database
+        :param topics: list of topic records, loaded from the collected pages when None
         :return: None
         """
         cur = self._postgresql_conn.cursor()
@@ -247,16 +354,8 @@ class AutoZendeskDB(object):
         );
         """
                     )
-        try:
-            data = self._load_json(os.path.join(self._save_path, 'topics.json'))
-        except IOError:
-            print("ERROR: IO ERROR when load {0}".format(self._save_path + r'\topics.json'))
-            quit()
-        except json.JSONDecodeError:
-            print("ERROR: Json file {0} decode error!".format(self._save_path + r'\topics.json'))
-            quit()
-
-        topics = data['topics']
+        if topics is None:
+            topics = [topic for _, topic in self._iter_records('topics', self._list_pages('topics'))]
         for topic in topics:
             created_at = topic['created_at']
             created_at_date = created_at[:10]
@@ -316,12 +415,15 @@ class AutoZendeskDB(object):
         cur.close()
         print("table isv_topics updated")
 
-    def _build_users_postgresql(self):
+    def _build_users_postgresql(self, users=None):
         """
-
-        :return:
+        build isv_users table in database
+        :param users: list of user records, loaded from the collected pages when None
+        :return: None
         """
-        self._build_json_users_file_list()
+        if users is None:
+            self._build_json_users_file_list()
+            users = [user for _, user in self._iter_records('users', self._json_users_filename_list)]
         cur = self._postgresql_conn.cursor()
 
         cur.execute("""
@@ -347,92 +449,62 @@ class AutoZendeskDB(object):
         """
                     )
 
-        for filename in self._json_users_filename_list:
-            try:
-                data = self._load_json(filename)
-            except IOError:
-                print("ERROR: IO ERROR when load {0}".format(filename))
-                quit()
-            except json.JSONDecodeError:
-                print("ERROR: Json file {0} decode error!".format(filename))
-                quit()
+        rows = dict()
+        for user in users:
+            # TODO: why 3 tickets here?
+            if 'body' in user.keys():
+                continue
 
-            users = data['users']
-            for user in users:
-                # TODO: why 3 tickets here?
-                if 'body' in user.keys():
-                    continue
-
-                created_at = user['created_at']
-                created_at_date = created_at[:10]
-                created_at_time = created_at[11:-1]
-                created_at = created_at_date + ' ' + created_at_time
-
-                updated_at = user['updated_at']
-                updated_at_date = updated_at[:10]
-                updated_at_time = updated_at[11:-1]
-                updated_at = updated_at_date + ' ' + updated_at_time
-
-                cur.execute("SELECT * FROM isv_users WHERE id = %s;", (str(user['id']),))
-                result = cur.fetchall()
-                # TODO
-                print(user)
-
-                if result:
-                    command = """UPDATE isv_users SET url = %s,
-                                name = %s,
-                                email = %s,
-                                created_at = %s,
-                                updated_at = %s,
-                                time_zone = %s,
-                                shared_phone_number = %s,
-                                locale_id = %s,
-                                locale = %s,
-                                organization_id = %s,
-                                role = %s,
-                                verified = %s,
-                                last_login_at = %s,
-                                restricted_agent = %s,  
-                                """
-                    cur.execute(command, (
-                        user['url'],
-                        user['name'],
-                        user['email'],
-                        created_at,
-                        updated_at,
-                        user['time_zone'],
-                        str(user['shared_phone_number']),
-                        str(user['locale_id']),
-                        user['locale'],
-                        str(user['organization_id']),
-                        user['role'],
-                        user['verified'],
-                        str(user['last_login_at']),
-                        user['restricted_agent'],
-                        str(user['id'])
-                    ))
-                else:
-                    command = "INSERT INTO isv_users VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);"
-                    a = (str(user['id']),
-                                          user['url'],
-                                          user['name'],
-                                          user['email'],
-                                          created_at,
-                                          updated_at,
-                                          user['time_zone'],
-                                          str(user['shared_phone_number']),
-                                          str(user['locale_id']),
-                                          user['locale'],
-                                          str(user['organization_id']),
-                                          user['role'],
-                                          user['verified'],
-                                          str(user['last_login_at']),
-                                          user['restricted_agent']
-                                          )
-                    print(type(a))
-                    print(len(a))
-                    print('A:', a)
-                    cur.execute(command, a)
+            created_at = user['created_at']
+            created_at_date = created_at[:10]
+            created_at_time = created_at[11:-1]
+            created_at = created_at_date + ' ' + created_at_time
+
+            updated_at = user['updated_at']
+            updated_at_date = updated_at[:10]
+            updated_at_time = updated_at[11:-1]
+            updated_at = updated_at_date + ' ' + updated_at_time
+
+            rows[str(user['id'])] = (str(user['id']),
+                                     user['url'],
+                                     user['name'],
+                                     user.get('email'),
+                                     created_at,
+                                     updated_at,
+                                     user.get('time_zone'),
+                                     str(user.get('phone')),
+                                     str(user.get('shared_phone_number')),
+                                     str(user.get('photo')),
+                                     str(user.get('locale_id')),
+                                     user.get('locale'),
+                                     str(user.get('organization_id')),
+                                     user.get('role'),
+                                     user.get('verified'),
+                                     str(user.get('last_login_at')),
+                                     user.get('restricted_agent'))
+
+        if rows:
+            # a user seen again gets its current name, role... in one statement
+            command = """INSERT INTO isv_users (id, url, name, email, created_at, updated_at, time_zone, phone,
+                        shared_phone_number, photo, locale_id, locale, organization_id, role, verified,
+                        last_login_at, restricted_agent) VALUES %s
+                        ON CONFLICT (id) DO UPDATE SET url = EXCLUDED.url,
+                        name = EXCLUDED.name,
+                        email = EXCLUDED.email,
+                        created_at = EXCLUDED.created_at,
+                        updated_at = EXCLUDED.updated_at,
+                        time_zone = EXCLUDED.time_zone,
+                        phone = EXCLUDED.phone,
+                        shared_phone_number = EXCLUDED.shared_phone_number,
+                        photo = EXCLUDED.photo,
+                        locale_id = EXCLUDED.locale_id,
+                        locale = EXCLUDED.locale,
+                        organization_id = EXCLUDED.organization_id,
+                        role = EXCLUDED.role,
+                        verified = EXCLUDED.verified,
+                        last_login_at = EXCLUDED.last_login_at,
+                        restricted_agent = EXCLUDED.restricted_agent;"""
+            psycopg2.extras.execute_values(cur, command, [rows[key] for key in sorted(rows)])
 
         self._postgresql_conn.commit()
         cur.close()
@@ -728,14 +800,12 @@ class AutoZendeskDB(object):
     @staticmethod
     def _load_json(filename):
         """
-        load json file
+        load json file, gzip or zstd compressed files are decompressed by their extension
         :param filename: file name of json file need to load
         :return: raw data loaded from json file
         """
         try:
-            with open(filename, encoding='utf8') as json_file:
-                data = json.load(json_file)
-                return data
+            return storage.load_json(filename)
         except json.JSONDecodeError:
             print("Error: Json file {0} decode error!".format(filename))
             quit()
@@ -1050,7 +1120,216 @@ class AutoZendeskDB(object):
             quit()
         return data
 
+    def _create_thread_state_table(self, cur):
+        """
+        create the table of the comment threads fully collected and stored,
+        with the updated_at(and comment_count of posts) of the post or ticket when it was collected.
+        """
+        cur.execute("CREATE TABLE IF NOT EXISTS isv_thread_state ("
+                    "entity VARCHAR, thread_id VARCHAR, updated_at VARCHAR, comment_count INTEGER, "
+                    "PRIMARY KEY (entity, thread_id));")
+
+    def _get_thread_state(self, entity):
+        """
+        :param entity: 'posts' or 'tickets'
+        :return: list of (id, updated_at, comment_count) of the threads in isv_thread_state
+        """
+        cur = self._postgresql_conn.cursor()
+        try:
+            cur.execute("SELECT thread_id, updated_at, comment_count FROM isv_thread_state WHERE entity = %s",
+                        (entity,))
+            data = cur.fetchall()
+        except psycopg2.ProgrammingError as info:
+            # nothing stored yet, every thread is new
+            print(info)
+            self._postgresql_conn.rollback()
+            data = []
+        cur.close()
+        return data
+
+    def get_posts_thread_state(self):
+        """
+        fetch the state of every post whose comment thread is stored, used by the crawler to skip unchanged
+        comment threads. a thread whose comments were not all collected has no state and is collected again.
+        :return: dict {post id: (updated_at, comment_count)}, updated_at in Zendesk format eg. 2018-01-18T14:06:16Z
+        """
+        return dict((post_id, (updated_at, comment_count))
+                    for post_id, updated_at, comment_count in self._get_thread_state('posts'))
+
+    def get_known_user_ids(self):
+        """
+        fetch the ids of the users stored in isv_users, used by the crawler to collect only unknown users.
+        :return: set of user ids
+        """
+        cur = self._postgresql_conn.cursor()
+        try:
+            cur.execute("SELECT id FROM isv_users")
+            data = cur.fetchall()
+        except psycopg2.ProgrammingError as info:
+            print(info)
+            self._postgresql_conn.rollback()
+            data = []
+        cur.close()
+        return set(row[0] for row in data)
+
+    def get_tickets_thread_state(self):
+        """
+        fetch the state of every ticket whose comment thread is stored, used by the crawler to skip unchanged
+        comment threads. tickets have no comment count, a new comment always changes updated_at of the ticket.
+        :return: dict {ticket id: updated_at}, updated_at in Zendesk format eg. 2018-01-18T14:06:16Z
+        """
+        return dict((ticket_id, updated_at) for ticket_id, updated_at, _ in self._get_thread_state('tickets'))
+
+    def _save_thread_state(self, records):
+        """
+        record the state of comment threads whose comments are stored.
+        :param records: list of thread state records {'entity', 'thread_id', 'updated_at', 'comment_count'}
+        :return: None
+        """
+        rows = dict(((record['entity'], str(record['thread_id'])),
+                     (record['entity'], str(record['thread_id']), record['updated_at'], record.get('comment_count')))
+                    for record in records)
+        cur = self._postgresql_conn.cursor()
+        self._create_thread_state_table(cur)
+        if rows:
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO isv_thread_state (entity, thread_id, updated_at, comment_count) VALUES %s "
+                "ON CONFLICT (entity, thread_id) DO UPDATE SET updated_at = EXCLUDED.updated_at, "
+                "comment_count = EXCLUDED.comment_count;",
+                [rows[key] for key in sorted(rows)])
+        self._postgresql_conn.commit()
+        cur.close()
+
+    def _create_thread_jobs_table(self, cur):
+        """
+        create the comment thread job table shared by the crawler workers.
+        status is 'queued', 'leased', 'done' or 'failed', a lease runs until lease_until.
+        updated_at and comment_count are the state of the thread recorded in isv_thread_state once it is done.
+        """
+        cur.execute("CREATE TABLE IF NOT EXISTS isv_thread_jobs ("
+                    "entity VARCHAR, thread_id VARCHAR, status VARCHAR NOT NULL DEFAULT 'queued', "
+                    "rank INTEGER, updated_at VARCHAR, attempts INTEGER NOT NULL DEFAULT 0, worker VARCHAR, "
+                    "lease_until TIMESTAMPTZ, error TEXT, comment_count INTEGER, PRIMARY KEY (entity, thread_id));")
+        # tables created before comment_count was kept, the catalog is checked first as ALTER TABLE locks the table
+        cur.execute("SELECT 1 FROM information_schema.columns "
+                    "WHERE table_name = 'isv_thread_jobs' AND column_name = 'comment_count';")
+        if not cur.fetchall():
+            cur.execute("ALTER TABLE isv_thread_jobs ADD COLUMN IF NOT EXISTS comment_count INTEGER;")
+        cur.execute("CREATE INDEX IF NOT EXISTS isv_thread_jobs_claim "
+                    "ON isv_thread_jobs (status, rank, updated_at DESC);")
+
+    def enqueue_thread_jobs(self, jobs):
+        """
+        queue comment threads in isv_thread_jobs for the crawler workers.
+        a thread already queued or leased is left alone unless it changed since,
+        a done or failed thread is queued again with its attempts reset.
+        :param jobs: list of ('posts'|'tickets', id, status rank, updated_at, comment_count),
+                     see _STATUS_PRIORITY of the crawler. comment_count is None for tickets
+        :return: None
+        """
+        rows = dict(((entity, str(id0)), (entity, str(id0), rank, updated_at, comment_count))
+                    for entity, id0, rank, updated_at, comment_count in jobs)
+        cur = self._postgresql_conn.cursor()
+        self._create_thread_jobs_table(cur)
+        if rows:
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO isv_thread_jobs (entity, thread_id, rank, updated_at, comment_count) VALUES %s "
+                "ON CONFLICT (entity, thread_id) DO UPDATE SET status = 'queued', rank = EXCLUDED.rank, "
+                "updated_at = EXCLUDED.updated_at, comment_count = EXCLUDED.comment_count, attempts = 0, "
+                "error = NULL "
+                "WHERE isv_thread_jobs.status IN ('done', 'failed') "
+                "OR isv_thread_jobs.updated_at IS DISTINCT FROM EXCLUDED.updated_at "
+                "OR isv_thread_jobs.comment_count IS DISTINCT FROM EXCLUDED.comment_count;",
+                [rows[key] for key in sorted(rows)])
+        self._postgresql_conn.commit()
+        cur.close()
+
+    def claim_thread_jobs(self, worker, limit, lease, max_attempts):
+        """
+        lease the next queued comment threads to a worker, open and latest updated first.
+        rows locked by another worker are skipped(FOR UPDATE SKIP LOCKED), so workers on several machines
+        never claim the same thread. threads whose lease expired are claimed again,
+        after max_attempts claims they are marked failed.
+        :param worker: id of the worker
+        :param limit: maximum number of threads to claim
+        :param lease: seconds the threads are leased for
+        :param max_attempts: claims of a thread before it is given up
+        :return: list of ('posts'|'tickets', id)
+        """
+        cur = self._postgresql_conn.cursor()
+        self._create_thread_jobs_table(cur)
+        cur.execute("UPDATE isv_thread_jobs SET status = 'failed', error = 'lease expired', worker = NULL, "
+                    "lease_until = NULL WHERE status = 'leased' AND lease_until < now() AND attempts >= %s;",
+                    (max_attempts,))
+        cur.execute("UPDATE isv_thread_jobs AS j SET status = 'leased', worker = %s, "
+                    "lease_until = now() + %s * interval '1 second', attempts = j.attempts + 1 "
+                    "FROM (SELECT entity, thread_id FROM isv_thread_jobs "
+                    "WHERE status = 'queued' OR (status = 'leased' AND lease_until < now()) "
+                    "ORDER BY rank, updated_at DESC LIMIT %s FOR UPDATE SKIP LOCKED) AS c "
+                    "WHERE j.entity = c.entity AND j.thread_id = c.thread_id "
+                    "RETURNING j.entity, j.thread_id;",
+                    (worker, lease, limit))
+        data = cur.fetchall()
+        self._postgresql_conn.commit()
+        cur.close()
+        return [(entity, thread_id) for entity, thread_id in data]
 
+    def complete_thread_jobs(self, worker, threads):
+        """
+        mark threads collected by a worker done and record their state in isv_thread_state,
+        threads whose lease went to another worker are not touched.
+        :param worker: id of the worker
+        :param threads: list of ('posts'|'tickets', id)
+        :return: None
+        """
+        if not threads:
+            return
+        cur = self._postgresql_conn.cursor()
+        self._create_thread_state_table(cur)
+        cur.execute("WITH done AS ("
+                    "UPDATE isv_thread_jobs SET status = 'done', worker = NULL, lease_until = NULL, error = NULL "
+                    "WHERE (entity, thread_id) IN %s AND status = 'leased' AND worker = %s "
+                    "RETURNING entity, thread_id, updated_at, comment_count) "
+                    "INSERT INTO isv_thread_state (entity, thread_id, updated_at, comment_count) "
+                    "SELECT entity, thread_id, updated_at, comment_count FROM done "
+                    "ON CONFLICT (entity, thread_id) DO UPDATE SET updated_at = EXCLUDED.updated_at, "
+                    "comment_count = EXCLUDED.comment_count;",
+                    (tuple(sorted(threads)), worker))
+        self._postgresql_conn.commit()
+        cur.close()
+
+    def fail_thread_jobs(self, worker, threads, error, max_attempts):
+        """
+        give back threads a worker could not collect, they are queued again until max_attempts claims.
+        :param worker: id of the worker
+        :param threads: list of ('posts'|'tickets', id)
+        :param error: reason of the failure
+        :param max_attempts: claims of a thread before it is given up
+        :return: None
+        """
+        if not threads:
+            return
+        cur = self._postgresql_conn.cursor()
+        cur.execute("UPDATE isv_thread_jobs SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END, "
+                    "worker = NULL, lease_until = NULL, error = %s "
+                    "WHERE (entity, thread_id) IN %s AND status = 'leased' AND worker = %s;",
+                    (max_attempts, error, tuple(sorted(threads)), worker))
+        self._postgresql_conn.commit()
+        cur.close()
+
+    def get_thread_jobs_counts(self):
+        """
+        :return: dict {status: number of threads} of isv_thread_jobs
+        """
+        cur = self._postgresql_conn.cursor()
+        self._create_thread_jobs_table(cur)
+        cur.execute("SELECT status, count(*) FROM isv_thread_jobs GROUP BY status;")
+        data = cur.fetchall()
+        self._postgresql_conn.commit()
+        cur.close()
+        return dict(data)
 
     def report_data(self):
         cur = self._postgresql_conn.cursor()
@@ -1127,10 +1406,7 @@ class AutoZendeskDB(object):
         return res
 
     def _build_json_tickets_file_list(self):
-        for root, dirs, files in os.walk(self._save_path):
-            for file in files:
-                if re.match('^ticket[0-9]+.json', file):
-                    self._json_tickets_filename_list.append(os.path.join(self._save_path, file))
+        self._json_tickets_filename_list = self._list_pages('tickets')
 
         # for j in self._json_comments_filename_list:
             # print(j)
@@ -1139,17 +1415,8 @@ class AutoZendeskDB(object):
             #     print(data)
 
     def _parse_json_tickets_file(self):
-        for file in self._json_tickets_filename_list:
-            try:
-                with open(file, 'r', encoding='utf8') as f:
-                    data = json.load(f)
-                    tickets = data['tickets']
-                    for ticket in tickets:
-                        self._tickets_id.append(str(ticket['id']))
-
-            except json.JSONDecodeError:
-                print("ERROR: Json file {0} decode error!".format(file))
-                quit()
+        for _, ticket in self._iter_records('tickets', self._json_tickets_filename_list):
+            self._tickets_id.append(str(ticket['id']))
 
     def _initial_tickets_postgresql(self):
         """
@@ -1165,18 +1432,15 @@ class AutoZendeskDB(object):
         cur = self._postgresql_conn.cursor()
         cur.execute("CREATE TABLE IF NOT EXISTS isv_tickets_json (id VARCHAR PRIMARY KEY, jdoc jsonb);")
 
-        for filename in self._json_tickets_filename_list:
-            data = self._load_json(filename)
-            tickets = data['tickets']
-            for ticket in tickets:
-                cur.execute("SELECT * FROM isv_tickets_json WHERE id = %s;", (str(ticket['id']),))
-                result = cur.fetchall()
-                if result:
-                    command = "UPDATE isv_tickets_json SET jdoc = %s WHERE id = %s;"
-                    cur.execute(command, [psycopg2.extras.Json(ticket), str(ticket['id'])])
-                else:
-                    cur.execute("INSERT INTO isv_tickets_json (id, jdoc) VALUES(%s, %s);",
-                                [str(ticket['id']), psycopg2.extras.Json(ticket)])
+        for _, ticket in self._iter_records('tickets', self._json_tickets_filename_list):
+            cur.execute("SELECT * FROM isv_tickets_json WHERE id = %s;", (str(ticket['id']),))
+            result = cur.fetchall()
+            if result:
+                command = "UPDATE isv_tickets_json SET jdoc = %s WHERE id = %s;"
+                cur.execute(command, [psycopg2.extras.Json(ticket), str(ticket['id'])])
+            else:
+                cur.execute("INSERT INTO isv_tickets_json (id, jdoc) VALUES(%s, %s);",
+                            [str(ticket['id']), psycopg2.extras.Json(ticket)])
 
         self._postgresql_conn.commit()
         cur.close()
@@ -1355,10 +1619,7 @@ class AutoZendeskDB(object):
         print("build ticket excel")
 
     def _build_json_tickets_comments_file_list(self):
-        for root, dirs, files in os.walk(self._save_path):
-            for file in files:
-                if re.match('^ticket_comm_.*.json', file):
-                    self._json_tickets_comments_filename_list.append(os.path.join(self._save_path, file))
+        self._json_tickets_comments_filename_list = self._list_pages('ticket_comments')
 
     def _initial_tickets_comments_postgresql(self):
         """
@@ -1375,25 +1636,18 @@ class AutoZendeskDB(object):
                      jdoc jsonb);
                      """)
 
-        for filename in self._json_tickets_comments_filename_list:
-            data = self._load_json(filename)
-            # find the ticket id from the filename
-            # the filename is save_path + ticket_comments_ticketid.json
-            save_path_length = len(self._save_path)
-            ticket_id = filename[save_path_length+13:-5]
-
-            comments = data['comments']
-            for comment in comments:
+        # the ticket id is found from the filename ticket_comm_<ticket id>[_<page>].json or kept in the segment
+        for ticket_id, comment in self._iter_records('ticket_comments', self._json_tickets_comments_filename_list):
 
-                cur.execute("SELECT * FROM isv_tcomments_json WHERE id=%s;", (str(comment['id']),))
-                result = cur.fetchall()
+            cur.execute("SELECT * FROM isv_tcomments_json WHERE id=%s;", (str(comment['id']),))
+            result = cur.fetchall()
 
-                if result:
-                    command = "UPDATE isv_tcomments_json SET jdoc = %s WHERE id = %s;"
-                    cur.execute(command, [psycopg2.extras.Json(comment), str(comment['id'])])
-                else:
-                    command = "INSERT INTO isv_tcomments_json (id, ticket_id, jdoc) VALUES(%s, %s, %s);"
-                    cur.execute(command, [str(comment['id']), str(ticket_id), psycopg2.extras.Json(comment)])
+            if result:
+                command = "UPDATE isv_tcomments_json SET jdoc = %s WHERE id = %s;"
+                cur.execute(command, [psycopg2.extras.Json(comment), str(comment['id'])])
+            else:
+                command = "INSERT INTO isv_tcomments_json (id, ticket_id, jdoc) VALUES(%s, %s, %s);"
+                cur.execute(command, [str(comment['id']), str(ticket_id), psycopg2.extras.Json(comment)])
 
         self._postgresql_conn.commit()
         cur.close()
@@ -1510,7 +1764,8 @@ class AutoZendeskDB(object):
         self._initial_comments_postgresql()
         self._build_comments_postgresql()
         self._build_topics_postgresql()
-        # self._build_users_postgresql()
+        # only the users referenced by the collected threads are collected, see the crawler
+        self._build_users_postgresql()
         self._build_update_record()
 
         self.build_posts_excel_from_db()
@@ -1525,6 +1780,36 @@ class AutoZendeskDB(object):
         self._build_tickets_comments_postgresql()
         self.build_tickets_comments_excel_from_db()
 
+        # the comments are stored, their threads are skipped by the next crawl until they change
+        self._initial_thread_state_postgresql()
+
+    def _initial_thread_state_postgresql(self):
+        """
+        load the state of the comment threads fully collected by the crawl into isv_thread_state.
+        :return: None
+        """
+        self._save_thread_state([record for _, record in
+                                 self._iter_records('thread_state', self._list_pages('thread_state'))])
+        print("table isv_thread_state updated")
+
+    def run_build_tables(self):
+        """
+        build the report tables and excel files from the json tables,
+        used after the crawler to database pipeline filled the json tables.
+        """
+        self._build_posts_postgresql()
+        self._build_comments_postgresql()
+        self._build_update_record()
+
+        self.build_posts_excel_from_db()
+        self.build_comments_excel_from_db()
+
+        self._build_tickets_postgresql()
+        self.build_tickets_excel_from_db()
+
+        self._build_tickets_comments_postgresql()
+        self.build_tickets_comments_excel_from_db()
+
     def run_users(self):
         self._initial_posts_postgresql()
         self._build_users_postgresql()
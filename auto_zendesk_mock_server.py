@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Local stand-in of the Zendesk api for testing and benchmarking the crawler offline.
+Serves synthetic posts, comments, topics, tickets and users with Zendesk style pagination,
+latency, server errors and 429 throttling can be injected.
+
+    python auto_zendesk_mock_server.py --port 8765 --posts 3000 --latency 0.05 --throttle-rate 0.01
+
+then crawl it with AutoZendeskCrawling(api_url='http://127.0.0.1:8765/api/v2/').
+"""
+
+# core mods
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+
+class AutoZendeskMockServer(object):
+    def __init__(self, port=0, posts=300, tickets=300, users=200, topics=10, comments_per_thread=5,
+                 page_size=30, latency=0.0, error_rate=0.0, throttle_rate=0.0, rate_limit=700, seed=0):
+        """
+        Synthetic Zendesk api server, the data is generated from the seed so every run serves the same bytes.
+        :param port: port to listen on, 0 picks a free port
+        :param posts: number of community posts
+        :param tickets: number of tickets
+        :param users: number of users, authors of posts, comments and tickets are picked from them
+        :param topics: number of community topics
+        :param comments_per_thread: average number of comments of a post or ticket
+        :param page_size: records per page
+        :param latency: average seconds added to every response
+        :param error_rate: fraction of requests answered with 500
+        :param throttle_rate: fraction of requests answered with 429 and Retry-After
+        :param rate_limit: X-Rate-Limit header sent with every response
+        :param seed: seed of the generated data
+        """
+        self._posts = posts
+        self._tickets = tickets
+        self._users = users
+        self._topics = topics
+        self._comments_per_thread = comments_per_thread
+        self._page_size = page_size
+        self._latency = latency
+        self._error_rate = error_rate
+        self._throttle_rate = throttle_rate
+        self._rate_limit = rate_limit
+        self._seed = seed
+        # dates of the generated records are spread over the 10 days before the server started
+        self._now = int(time.time())
+
+        self._lock = threading.Lock()
+        self._counters = {'requests': 0, 'pages': 0, 'not_modified': 0, 'errors': 0, 'throttled': 0, 'bytes': 0}
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), self._build_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+        # the lists are generated once, pages are slices of them
+        self._post_list = [self._post(post_id) for post_id in range(1, posts + 1)]
+        self._post_list_by_update = sorted(self._post_list, key=lambda post: post['updated_at'], reverse=True)
+        self._ticket_list = [self._ticket(ticket_id) for ticket_id in range(1, tickets + 1)]
+        self._ticket_list_by_update = sorted(self._ticket_list, key=lambda ticket: ticket['updated_at'])
+        self._user_list = [self._user(user_id) for user_id in range(1, users + 1)]
+        self._topic_list = [self._topic(topic_id) for topic_id in range(1, topics + 1)]
+
+    @property
+    def url(self):
+        """
+        :return: base url of the api, pass it as api_url of the crawler
+        """
+        return 'http://127.0.0.1:{0}/api/v2/'.format(self._httpd.server_address[1])
+
+    def start(self):
+        """
+        serve in a background thread.
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='mock-zendesk', daemon=True)
+        self._thread.start()
+
+    def serve(self):
+        """
+        serve in the calling thread until interrupted.
+        :return: None
+        """
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self._httpd.server_close()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def get_counters(self):
+        """
+        :return: dict of 'requests', 'pages'(200 answers), 'not_modified', 'errors', 'throttled' and 'bytes' sent
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def _random(self, kind, record_id):
+        return random.Random('{0}-{1}-{2}'.format(self._seed, kind, record_id))
+
+    def _timestamp(self, seconds):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+    def _record_times(self, rnd):
+        updated = self._now - rnd.randint(0, 10 * 24 * 3600)
+        created = updated - rnd.randint(0, 30 * 24 * 3600)
+        return self._timestamp(created), self._timestamp(updated)
+
+    def _comment_count(self, kind, thread_id):
+        return self._random(kind + '-count', thread_id).randint(0, 2 * self._comments_per_thread)
+
+    def _post(self, post_id):
+        rnd = self._random('post', post_id)
+        created_at, updated_at = self._record_times(rnd)
+        return {'id': post_id,
+                'url': self.url + 'community/posts/{0}.json'.format(post_id),
+                'html_url': 'https://mock.zendesk.com/hc/en-us/community/posts/{0}'.format(post_id),
+                'title': 'Post {0}'.format(post_id),
+                'details': '<p>' + ' '.join('word{0}'.format(rnd.randint(0, 999)) for _ in range(60)) + '</p>',
+                'author_id': rnd.randint(1, self._users),
+                'vote_sum': rnd.randint(0, 20),
+                'vote_count': rnd.randint(0, 20),
+                'comment_count': self._comment_count('post', post_id),
+                'follower_count': rnd.randint(0, 10),
+                'topic_id': rnd.randint(1, max(1, self._topics)),
+                'created_at': created_at,
+                'updated_at': updated_at,
+                'pinned': False,
+                'featured': False,
+                'closed': False,
+                'status': rnd.choice(['none', 'planned', 'answered', 'completed'])}
+
+    def _comment(self, kind, thread_id, index):
+        rnd = self._random(kind + '-comment', '{0}-{1}'.format(thread_id, index))
+        created_at, updated_at = self._record_times(rnd)
+        comment = {'id': thread_id * 1000 + index,
+                   'body': '<p>' + ' '.join('word{0}'.format(rnd.randint(0, 999)) for _ in range(40)) + '</p>',
+                   'author_id': rnd.randint(1, self._users),
+                   'created_at': created_at,
+                   'updated_at': updated_at}
+        if kind == 'post':
+            comment.update({'post_id': thread_id, 'official': rnd.random() < 0.1, 'vote_sum': rnd.randint(0, 5),
+                            'vote_count': rnd.randint(0, 5),
+                            'url': self.url + 'community/posts/{0}/comments/{1}.json'.format(thread_id,
+                                                                                          comment['id'])})
+        else:
+            comment.update({'type': 'Comment', 'public': True, 'attachments': []})
+        return comment
+
+    def _ticket(self, ticket_id):
+        rnd = self._random('ticket', ticket_id)
+        created_at, updated_at = self._record_times(rnd)
+        return {'id': ticket_id,
+                'url': self.url + 'tickets/{0}.json'.format(ticket_id),
+                'subject': 'Ticket {0}'.format(ticket_id),
+                'description': ' '.join('word{0}'.format(rnd.randint(0, 999)) for _ in range(50)),
+                'status': rnd.choice(['new', 'open', 'pending', 'solved', 'closed']),
+                'priority': rnd.choice([None, 'low', 'normal', 'high']),
+                'type': rnd.choice([None, 'question', 'incident', 'problem']),
+                'requester_id': rnd.randint(1, self._users),
+                'submitter_id': rnd.randint(1, self._users),
+                'assignee_id': rnd.choice([None, rnd.randint(1, self._users)]),
+                'organization_id': None,
+                'tags': [],
+                'created_at': created_at,
+                'updated_at': updated_at}
+
+    def _user(self, user_id):
+        rnd = self._random('user', user_id)
+        created_at, updated_at = self._record_times(rnd)
+        return {'id': user_id,
+                'url': self.url + 'users/{0}.json'.format(user_id),
+                'name': 'User {0}'.format(user_id),
+                'email': 'user{0}@example.com'.format(user_id),
+                'created_at': created_at,
+                'updated_at': updated_at,
+                'time_zone': 'Pacific Time (US & Canada)',
+                'phone': None,
+                'shared_phone_number': None,
+                'photo': None,
+                'locale_id': 1,
+                'locale': 'en-US',
+                'organization_id': None,
+                'role': rnd.choice(['end-user', 'end-user', 'agent']),
+                'verified': True,
+                'last_login_at': updated_at,
+                'restricted_agent': False}
+
+    def _topic(self, topic_id):
+        return {'id': topic_id,
+                'url': self.url + 'community/topics/{0}.json'.format(topic_id),
+                'html_url': 'https://mock.zendesk.com/hc/en-us/community/topics/{0}'.format(topic_id),
+                'name': 'Topic {0}'.format(topic_id),
+                'description': 'Synthetic topic {0}'.format(topic_id),
+                'position': topic_id,
+                'follower_count': 0,
+                'created_at': self._timestamp(self._now - 365 * 24 * 3600),
+                'updated_at': self._timestamp(self._now - 365 * 24 * 3600)}
+
+    def _paged(self, key, records, path, query):
+        """
+        one page of a Zendesk offset paginated list.
+        :param key: key of the records array
+        :param records: every record of the list
+        :param path: path of the list, used to build next_page
+        :param query: parsed query string
+        :return: dict of the page
+        """
+        page = int(query.get('page', ['1'])[0])
+        page_count = max(1, (len(records) + self._page_size - 1) // self._page_size)
+        next_page = None
+        if page < page_count:
+            params = dict((name, values[0]) for name, values in query.items())
+            params['page'] = page + 1
+            next_page = self.url + path + '?' + urllib.parse.urlencode(params)
+        return {key: records[(page - 1) * self._page_size:page * self._page_size],
+                'page': page,
+                'page_count': page_count,
+                'per_page': self._page_size,
+                'count': len(records),
+                'next_page': next_page,
+                'previous_page': None}
+
+    def _search(self, result_type, records, since, path, query):
+        """
+        one page of a search of the records updated after since, sorted by updated_at ascending.
+        like Zendesk only the first 1000 results can be read.
+        :param result_type: result_type of the results eg. 'ticket'
+        :param records: every record sorted by updated_at ascending
+        :param since: timestamp or day, only the records updated after it are found
+        :param path: path of the search, used to build next_page
+        :param query: parsed query string
+        :return: dict of the page
+        """
+        found = [dict(record, result_type=result_type) for record in records if record['updated_at'] > since]
+        page = self._paged('results', found[:1000], path, query)
+        page['count'] = len(found)
+        return page
+
+    def _incremental_tickets(self, query):
+        """
+        one page of the cursor based incremental tickets export, tickets ordered by updated_at.
+        :param query: parsed query string, start_time or cursor
+        :return: dict of the page
+        """
+        tickets = self._ticket_list_by_update
+        if 'cursor' in query:
+            offset = int(query['cursor'][0])
+        else:
+            start_time = self._timestamp(int(query.get('start_time', ['0'])[0]))
+            offset = len([ticket for ticket in tickets if ticket['updated_at'] < start_time])
+        end = min(len(tickets), offset + self._page_size)
+        return {'tickets': tickets[offset:end],
+                'after_cursor': str(end),
+                'after_url': self.url + 'incremental/tickets/cursor.json?cursor=' + str(end),
+                'before_cursor': str(offset),
+                'end_of_stream': end >= len(tickets)}
+
+    def build_response(self, path, query):
+        """
+        answer of an api path.
+        :param path: path under /api/v2/ eg. 'community/posts.json'
+        :param query: parsed query string
+        :return: dict of the response body, None if the path is unknown
+        """
+        if path == 'community/posts.json':
+            if query.get('sort_by', [''])[0] == 'updated_at':
+                return self._paged('posts', self._post_list_by_update, path, query)
+            return self._paged('posts', self._post_list, path, query)
+        if path == 'community/topics.json':
+            return self._paged('topics', self._topic_list, path, query)
+        if path == 'tickets.json':
+            return self._paged('tickets', self._ticket_list, path, query)
+        if path == 'users.json':
+            return self._paged('users', self._user_list, path, query)
+        if path == 'users/show_many.json':
+            ids = [int(user_id) for user_id in query.get('ids', [''])[0].split(',') if user_id.isdigit()]
+            return {'users': [self._user_list[user_id - 1] for user_id in ids if 1 <= user_id <= self._users]}
+        if path == 'tickets/show_many.json':
+            ids = [int(ticket_id) for ticket_id in query.get('ids', [''])[0].split(',') if ticket_id.isdigit()]
+            return {'tickets': [self._ticket_list[ticket_id - 1] for ticket_id in ids
+                                if 1 <= ticket_id <= self._tickets]}
+        if path == 'incremental/tickets/cursor.json':
+            return self._incremental_tickets(query)
+        if path == 'search.json':
+            m = re.match(r'^type:ticket updated>(\S+)$', query.get('query', [''])[0])
+            if m is None:
+                return None
+            return self._search('ticket', self._ticket_list_by_update, m.group(1), path, query)
+        if path == 'help_center/community_posts/search.json':
+            return self._search('community_post', self._post_list_by_update[::-1],
+                                query.get('updated_after', [''])[0], path, query)
+
+        m = re.match(r'^community/posts/([0-9]+)\.json$', path)
+        if m:
+            post_id = int(m.group(1))
+            if post_id < 1 or post_id > self._posts:
+                return None
+            return {'post': self._post_list[post_id - 1]}
+
+        m = re.match(r'^(community/posts|tickets)/([0-9]+)/comments\.json$', path)
+        if m:
+            kind = 'post' if m.group(1) == 'community/posts' else 'ticket'
+            thread_id = int(m.group(2))
+            if thread_id < 1 or thread_id > (self._posts if kind == 'post' else self._tickets):
+                return None
+            comments = [self._comment(kind, thread_id, index)
+                        for index in range(1, self._comment_count(kind, thread_id) + 1)]
+            return self._paged('comments', comments, path, query)
+        return None
+
+    def _build_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                self.send_header('X-Rate-Limit', str(server._rate_limit))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server._count('bytes', len(body))
+
+            def do_GET(self):
+                server._count('requests')
+                if server._latency:
+                    time.sleep(random.expovariate(1.0 / server._latency))
+                dice = random.random()
+                if dice < server._throttle_rate:
+                    server._count('throttled')
+                    self._send(429, headers={'Retry-After': '1'})
+                    return
+                if dice < server._throttle_rate + server._error_rate:
+                    server._count('errors')
+                    self._send(500)
+                    return
+
+                url = urllib.parse.urlparse(self.path)
+                if not url.path.startswith('/api/v2/'):
+                    self._send(404)
+                    return
+                data = server.build_response(url.path[len('/api/v2/'):], urllib.parse.parse_qs(url.query))
+                if data is None:
+                    self._send(404)
+                    return
+
+                body = json.dumps(data).encode('utf8')
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    server._count('not_modified')
+                    self._send(304, headers={'ETag': etag})
+                    return
+                server._count('pages')
+                self._send(200, body, {'Content-Type': 'application/json; charset=utf-8', 'ETag': etag})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local mock of the Zendesk api')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--posts', type=int, default=300)
+    parser.add_argument('--tickets', type=int, default=300)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--comments-per-thread', type=int, default=5)
+    parser.add_argument('--page-size', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.0, help='average seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    args = parser.parse_args()
+
+    mock = AutoZendeskMockServer(port=args.port, posts=args.posts, tickets=args.tickets, users=args.users,
+                                 topics=args.topics, comments_per_thread=args.comments_per_thread,
+                                 page_size=args.page_size, latency=args.latency, error_rate=args.error_rate,
+                                 throttle_rate=args.throttle_rate)
+    print("mock Zendesk api on {0}".format(mock.url))
+    mock.serve()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Pipelined sync: crawler fetch workers push parsed pages onto a bounded queue,
+database writer workers upsert them in batches while the crawl is still running.
+AutoZendeskDBSink writes the pages straight away instead, for the sync services collecting a few threads at a time.
+"""
+
+# core mods
+import functools
+import queue
+import threading
+
+# the writers stop when they get this
+_STOP = object()
+
+
+class AutoZendeskPipeline(object):
+    def __init__(self, crawler, db_factory, writers=2, queue_size=64, batch_size=500):
+        """
+        Stream the crawl straight into the database.
+        the crawler can be built with output=None to skip disk entirely, or keep output='files' to archive pages.
+        :param crawler: AutoZendeskCrawling instance
+        :param db_factory: callable returning a new AutoZendeskDB, every writer uses its own connection.
+                           when the crawler crawls several instances it is called with the subdomain of an
+                           instance and must return a database of that instance,
+                           eg. lambda instance: AutoZendeskDB(..., instance=instance)
+        :param writers: number of database writer workers
+        :param queue_size: maximum number of pages waiting for the writers, a full queue slows the crawl down
+        :param batch_size: number of records upserted in one statement
+        """
+        self._crawler = crawler
+        self._db_factory = db_factory
+        # subdomain -> crawler of every instance, the pages of an instance go to the database of the instance
+        self._instance_crawlers = crawler.get_instance_crawlers()
+        if list(self._instance_crawlers.values()) == [crawler]:
+            self._instance_crawlers = None
+        self._writers = max(1, writers)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._records_written = 0
+        self._failed = False
+        # instance -> thread state items, written once every comment is stored
+        self._thread_state = dict()
+
+    def _new_db(self, instance):
+        """
+        :param instance: subdomain of the instance, None with a single instance crawler
+        :return: AutoZendeskDB of the instance
+        """
+        if instance is None:
+            return self._db_factory()
+        return self._db_factory(instance)
+
+    def _put_page(self, instance, entity, parent_id, records):
+        """
+        page sink of the crawler, blocks while the queue is full.
+        :param instance: subdomain of the instance the page comes from, None with a single instance crawler
+        :param entity: entity type eg. 'posts'
+        :param parent_id: post or ticket id of comments
+        :param records: records of the page
+        :return: None
+        """
+        if entity == 'thread_state':
+            # the comments of the threads may still wait in the queue, see run()
+            with self._lock:
+                self._thread_state.setdefault(instance, []).extend((parent_id, record) for record in records)
+        elif records:
+            self._queue.put((instance, entity, parent_id, records))
+
+    def _flush(self, db, entity, items):
+        try:
+            db.upsert_json_records(entity, items)
+        except Exception as e:
+            # keep consuming the queue so the crawler is never blocked by a dead writer
+            print("ERROR: upsert of {0} {1} records failed: {2}".format(len(items), entity, e))
+            with self._lock:
+                self._failed = True
+            return
+        with self._lock:
+            self._records_written += len(items)
+
+    def _open_db(self, instance):
+        """
+        open the database of an instance for a writer.
+        :param instance: subdomain of the instance, None with a single instance crawler
+        :return: AutoZendeskDB, None if it can not be opened
+        """
+        try:
+            return self._new_db(instance)
+        except Exception as e:
+            # the records of the instance are dropped, the queue is still consumed so the crawl is never blocked
+            print("ERROR: can not open the database{0}: {1}".format(
+                '' if instance is None else ' of ' + instance, e))
+            with self._lock:
+                self._failed = True
+            return None
+
+    def _writer(self):
+        """
+        database writer worker, batches records per instance and entity type and upserts them
+        into the database of the instance.
+        :return: None
+        """
+        dbs = dict()
+        batches = dict()
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            instance, entity, parent_id, records = item
+            if instance not in dbs:
+                dbs[instance] = self._open_db(instance)
+            if dbs[instance] is None:
+                continue
+            batch = batches.setdefault((instance, entity), [])
+            batch.extend((parent_id, record) for record in records)
+            if len(batch) >= self._batch_size:
+                self._flush(dbs[instance], entity, batch)
+                batches[(instance, entity)] = []
+
+        for (instance, entity), batch in batches.items():
+            if batch:
+                self._flush(dbs[instance], entity, batch)
+
+    def run(self):
+        """
+        crawl and upsert at the same time, then build the report tables from the json tables.
+        :return: True if every batch is written and the report tables are built
+        """
+        threads = [threading.Thread(target=self._writer, name='db-writer-{0}'.format(i))
+                   for i in range(self._writers)]
+        for t in threads:
+            t.start()
+
+        if self._instance_crawlers is None:
+            self._crawler.set_page_sink(functools.partial(self._put_page, None))
+        else:
+            for instance, crawler in self._instance_crawlers.items():
+                crawler.set_page_sink(functools.partial(self._put_page, instance))
+        try:
+            self._crawler.run_all()
+        finally:
+            self._crawler.set_page_sink(None)
+            for _ in threads:
+                self._queue.put(_STOP)
+            for t in threads:
+                t.join()
+
+        print("pipeline wrote {0} records".format(self._records_written))
+        for instance in self._instance_crawlers or [None]:
+            db = self._open_db(instance)
+            if db is None:
+                continue
+            # a failed batch may hold comments of any thread, then no thread is recorded as stored
+            if not self._failed and self._thread_state.get(instance):
+                self._flush(db, 'thread_state', self._thread_state[instance])
+            db.run_build_tables()
+        return not self._failed
+
+
+class AutoZendeskDBSink(object):
+    def __init__(self, db):
+        """
+        Page sink upserting every page as it arrives through one database connection,
+        used by the sync daemon, the webhook receiver and the thread workers.
+        an upsert error is raised to the crawler, so the thread of the page is reported as not collected.
+        :param db: AutoZendeskDB
+        """
+        self._db = db
+        # the crawler calls the sink from its worker threads, the connection is used by one at a time
+        self._lock = threading.Lock()
+
+    def __call__(self, entity, parent_id, records):
+        """
+        :param entity: entity type eg. 'posts'
+        :param parent_id: post or ticket id of comments
+        :param records: records of the page
+        :return: None
+        """
+        if not records:
+            return
+        with self._lock:
+            self._db.upsert_json_records(entity, [(parent_id, record) for record in records])
+
+    def call(self, method, *args, **kwargs):
+        """
+        call a method of the database, serialized with the upserts of the sink.
+        :param method: name of the AutoZendeskDB method eg. 'claim_thread_jobs'
+        :return: what the method returns
+        """
+        with self._lock:
+            return getattr(self._db, method)(*args, **kwargs)
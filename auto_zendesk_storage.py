@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Storage of the crawler output shared by the crawler and the database loader.
+Pages can be saved plain(.json), gzip(.json.gz) or zstd(.json.zst) compressed,
+readers pick the decompression from the file extension.
+Records can also be kept in an append-only segment store, one JSONL segment per entity type per run.
+Response bodies can be kept in a validator cache and revalidated with conditional GETs.
+"""
+
+# core mods
+import collections
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+
+# 3rd party mods
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# file name suffix of each supported compression
+COMPRESSION_SUFFIX = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# entity type of a saved page by its file name, the first group is the parent(post/ticket) id or the page
+PAGE_PATTERNS = (
+    ('ticket_comments', re.compile(r'^ticket_comm_([0-9]+)(?:_([0-9]+))?\.json(?:\.gz|\.zst)?$')),
+    ('comments', re.compile(r'^comments_([0-9]+)(?:_([0-9]+))?\.json(?:\.gz|\.zst)?$')),
+    # search results pages and pages of records requested by id, named apart from the listing pages
+    ('tickets', re.compile(r'^ticket_(?:search|show)_([0-9]+)\.json(?:\.gz|\.zst)?$')),
+    ('posts', re.compile(r'^post_(?:search|show)_([0-9]+)\.json(?:\.gz|\.zst)?$')),
+    ('tickets', re.compile(r'^ticket([0-9]+)\.json(?:\.gz|\.zst)?$')),
+    ('posts', re.compile(r'^post([0-9]+)\.json(?:\.gz|\.zst)?$')),
+    ('users', re.compile(r'^users_([0-9]+)\.json(?:\.gz|\.zst)?$')),
+    ('topics', re.compile(r'^topics\.json(?:\.gz|\.zst)?$')),
+    # state of the comment threads fully collected, saved by the crawler after their comments
+    ('thread_state', re.compile(r'^thread_state_(?:posts|tickets)_([0-9]+)\.json(?:\.gz|\.zst)?$')),
+)
+
+# key of the records array in a page of each entity type
+RECORD_KEY = {
+    'posts': 'posts',
+    'comments': 'comments',
+    'topics': 'topics',
+    'tickets': 'tickets',
+    'ticket_comments': 'comments',
+    'users': 'users',
+    'thread_state': 'thread_state',
+}
+
+# key of the record of a single record response eg. community/posts/<id>.json
+SINGLE_RECORD_KEY = {
+    'posts': 'post',
+    'topics': 'topic',
+    'tickets': 'ticket',
+    'users': 'user',
+}
+
+
+def page_records(entity, data):
+    """
+    records of a page, a single record response gives a list of one record
+    and a search results page the records under 'results'.
+    :param entity: entity type of the page eg. 'posts'
+    :param data: parsed page
+    :return: list of records
+    """
+    if RECORD_KEY[entity] in data:
+        return data[RECORD_KEY[entity]]
+    if SINGLE_RECORD_KEY.get(entity) in data:
+        return [data[SINGLE_RECORD_KEY[entity]]]
+    if 'results' in data:
+        return data['results']
+    return []
+
+
+def check_compression(compression):
+    """
+    check the compression is supported in this environment.
+    :param compression: None, 'gzip' or 'zstd'
+    :return: None
+    """
+    if compression not in COMPRESSION_SUFFIX:
+        raise ValueError("unknown compression {0}, use one of None, 'gzip', 'zstd'".format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard module")
+
+
+def stored_name(file_name, compression):
+    """
+    file name of a page saved with the compression.
+    :param file_name: plain file name eg. post1.json
+    :param compression: None, 'gzip' or 'zstd'
+    :return: file name with the compression suffix eg. post1.json.gz
+    """
+    return file_name + COMPRESSION_SUFFIX[compression]
+
+
+def find_stored(path):
+    """
+    find a saved page whatever compression it is saved with.
+    :param path: plain path eg. OUTPUT_PATH/topics.json
+    :return: existing path with its compression suffix, the plain path if none exists
+    """
+    for suffix in COMPRESSION_SUFFIX.values():
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+
+def remove_stored(path):
+    """
+    remove every saved variant(plain and compressed) of a page.
+    :param path: plain path eg. OUTPUT_PATH/post1.json
+    :return: None
+    """
+    for suffix in COMPRESSION_SUFFIX.values():
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def open_write(path, compression):
+    """
+    open a binary stream writing to path with the compression.
+    :param path: file path
+    :param compression: None, 'gzip' or 'zstd'
+    :return: writable binary file object
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+def open_read(path):
+    """
+    open a binary stream reading a saved page, decompressed on the fly by its extension.
+    :param path: file path
+    :return: readable binary file object
+    """
+    if path.endswith(COMPRESSION_SUFFIX['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(COMPRESSION_SUFFIX['zstd']):
+        if zstandard is None:
+            raise IOError("zstandard module is needed to read {0}".format(path))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def load_json(path):
+    """
+    load a saved json page, plain or compressed.
+    :param path: file path
+    :return: data loaded from the page
+    """
+    with open_read(path) as f:
+        return json.load(io.TextIOWrapper(f, encoding='utf8'))
+
+
+def describe_page(file_name):
+    """
+    find entity type, parent id and page number of a page from its file name.
+    :param file_name: file name of the page eg. ticket_comm_1234_2.json
+    :return: (entity, parent id, page), (None, None, None) for an unknown file name
+    """
+    for entity, pattern in PAGE_PATTERNS:
+        m = pattern.match(os.path.basename(file_name))
+        if m is None:
+            continue
+        if entity in ('comments', 'ticket_comments'):
+            return entity, m.group(1), int(m.group(2) or 1)
+        if entity == 'topics':
+            return entity, None, 1
+        return entity, None, int(m.group(1))
+    return None, None, None
+
+
+def scan_pages(root_path, entity):
+    """
+    find the saved pages of one entity type by walking the output path.
+    only used when there is no manifest of the run.
+    :param root_path: output path
+    :param entity: entity type eg. 'posts'
+    :return: list of page paths
+    """
+    pages = []
+    for root, dirs, files in os.walk(root_path):
+        for file in files:
+            if describe_page(file)[0] == entity:
+                pages.append(os.path.join(root, file))
+    return pages
+
+
+def iter_file_records(file_names, entity):
+    """
+    stream the records of saved pages.
+    :param file_names: list of page file names
+    :param entity: entity type of the pages eg. 'posts'
+    :return: generator of (parent id, record)
+    """
+    for file_name in file_names:
+        parent_id = describe_page(file_name)[1]
+        for record in page_records(entity, load_json(file_name)):
+            yield parent_id, record
+
+
+class RecordStore(object):
+    def __init__(self, root_path, run_id):
+        """
+        Append-only record store, one JSONL segment per entity type per run.
+        every line is {"parent_id": ..., "doc": {...}}, an offset index(<entity>.idx.json) maps each
+        record id to the offset and length of its line so a single record can be read without a scan.
+        :param root_path: output path, segments are saved under root_path/segments/run_id
+        :param run_id: id of the crawl run
+        """
+        self._path = os.path.join(root_path, 'segments', run_id)
+        self._lock = threading.Lock()
+        self._segments = dict()
+        self._index = dict()
+
+    @staticmethod
+    def latest_run_id(root_path):
+        """
+        find the id of the latest run saved under root_path.
+        :param root_path: output path
+        :return: run id, None if no run is saved
+        """
+        segments_path = os.path.join(root_path, 'segments')
+        if not os.path.isdir(segments_path):
+            return None
+        runs = sorted(os.listdir(segments_path))
+        return runs[-1] if runs else None
+
+    def _segment_file(self, entity):
+        return os.path.join(self._path, entity + '.jsonl')
+
+    def _index_file(self, entity):
+        return os.path.join(self._path, entity + '.idx.json')
+
+    def append(self, entity, records, parent_id=None):
+        """
+        append records of one entity type to its segment.
+        :param entity: entity type eg. 'posts'
+        :param records: list of records
+        :param parent_id: id of the post or ticket the records belong to(comments only)
+        :return: None
+        """
+        lines = [(str(record.get('id')),
+                  (json.dumps({'parent_id': parent_id, 'doc': record}) + '\n').encode('utf8'))
+                 for record in records]
+        with self._lock:
+            segment = self._segments.get(entity)
+            if segment is None:
+                os.makedirs(self._path, exist_ok=True)
+                # a resumed run appends to its segment, the index of the lines already there is rebuilt
+                self._index[entity] = self._scan_index(entity)
+                segment = open(self._segment_file(entity), 'ab')
+                self._segments[entity] = segment
+            offset = segment.tell()
+            for record_id, line in lines:
+                segment.write(line)
+                self._index[entity].append([record_id, offset, len(line)])
+                offset += len(line)
+
+    def _scan_index(self, entity):
+        """
+        build the offset index of an existing segment.
+        :param entity: entity type eg. 'posts'
+        :return: list of [record id, offset, length]
+        """
+        index = []
+        segment_file = self._segment_file(entity)
+        if not os.path.exists(segment_file):
+            return index
+        offset = 0
+        with open(segment_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # a line cut by a crash, it is overwritten by the next append
+                    f.close()
+                    with open(segment_file, 'r+b') as g:
+                        g.truncate(offset)
+                    break
+                index.append([str(json.loads(line)['doc'].get('id')), offset, len(line)])
+                offset += len(line)
+        return index
+
+    def close(self):
+        """
+        close the segments and save their offset index.
+        :return: None
+        """
+        with self._lock:
+            for entity, segment in self._segments.items():
+                segment.close()
+                tmp_file = self._index_file(entity) + '.tmp'
+                with open(tmp_file, 'w', encoding='utf8') as f:
+                    json.dump(self._index[entity], f)
+                os.replace(tmp_file, self._index_file(entity))
+            self._segments = dict()
+
+    def iter_records(self, entity):
+        """
+        stream the records of one entity type.
+        :param entity: entity type eg. 'posts'
+        :return: generator of (parent id, record)
+        """
+        with self._lock:
+            # records appended by this run may still sit in the write buffer
+            if entity in self._segments:
+                self._segments[entity].flush()
+        segment_file = self._segment_file(entity)
+        if not os.path.exists(segment_file):
+            return
+        with open(segment_file, 'rb') as f:
+            for line in f:
+                item = json.loads(line)
+                yield item['parent_id'], item['doc']
+
+    def get(self, entity, record_id):
+        """
+        read one record through the offset index, the latest copy wins.
+        :param entity: entity type eg. 'posts'
+        :param record_id: id of the record
+        :return: record, None if not found
+        """
+        with open(self._index_file(entity), 'r', encoding='utf8') as f:
+            index = json.load(f)
+        for rid, offset, length in reversed(index):
+            if rid == str(record_id):
+                with open(self._segment_file(entity), 'rb') as segment:
+                    segment.seek(offset)
+                    return json.loads(segment.read(length))['doc']
+        return None
+
+
+class CrawlManifest(object):
+    def __init__(self, root_path, run_id):
+        """
+        Manifest of the pages saved by one crawl run, one JSON line per page:
+        entity type, parent id, page, path, byte size and fetch time.
+        later stages read their file lists from it instead of walking the output path.
+        :param root_path: output path, the manifest is saved as root_path/manifests/<run_id>.jsonl
+        :param run_id: id of the crawl run
+        """
+        self._file = os.path.join(root_path, 'manifests', run_id + '.jsonl')
+        self._lock = threading.Lock()
+        self._entries = []
+        if os.path.exists(self._file):
+            with open(self._file, 'r', encoding='utf8') as f:
+                self._entries = [json.loads(line) for line in f if line.strip()]
+
+    @staticmethod
+    def latest(root_path):
+        """
+        load the manifest of the latest run saved under root_path.
+        :param root_path: output path
+        :return: CrawlManifest, None if no manifest is saved
+        """
+        manifests_path = os.path.join(root_path, 'manifests')
+        if not os.path.isdir(manifests_path):
+            return None
+        runs = sorted(file[:-len('.jsonl')] for file in os.listdir(manifests_path) if file.endswith('.jsonl'))
+        if not runs:
+            return None
+        return CrawlManifest(root_path, runs[-1])
+
+    def add(self, path):
+        """
+        record a saved page.
+        :param path: path of the saved page
+        :return: None
+        """
+        entity, parent_id, page = describe_page(path)
+        entry = {'entity': entity,
+                 'id': parent_id,
+                 'page': page,
+                 'path': path,
+                 'bytes': os.path.getsize(path),
+                 'fetched_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+        with self._lock:
+            os.makedirs(os.path.dirname(self._file), exist_ok=True)
+            with open(self._file, 'a', encoding='utf8') as f:
+                f.write(json.dumps(entry) + '\n')
+            self._entries.append(entry)
+
+    def files(self, entity):
+        """
+        paths of the pages of one entity type saved in this run, a page fetched twice is listed once.
+        :param entity: entity type eg. 'posts'
+        :return: list of page paths
+        """
+        with self._lock:
+            paths = [entry['path'] for entry in self._entries if entry['entity'] == entity]
+        return list(dict.fromkeys(paths))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ValidatorCache(object):
+    def __init__(self, root_path, max_bytes=256 * 1024 * 1024):
+        """
+        On-disk HTTP cache of response bodies keyed by URL, with the ETag and Last-Modified the server sent.
+        the crawler sends them back as If-None-Match/If-Modified-Since and reuses the cached body on 304.
+        least recently used bodies are evicted once the cache grows over max_bytes.
+        :param root_path: output path, bodies are kept in root_path/http_cache
+        :param max_bytes: size limit of the cached bodies
+        """
+        self._path = os.path.join(root_path, 'http_cache')
+        self._index_file = os.path.join(self._path, 'index.json')
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # url -> {'etag', 'last_modified', 'key', 'bytes'}, least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self._index_file):
+            try:
+                with open(self._index_file, 'r', encoding='utf8') as f:
+                    self._entries.update(json.load(f))
+            except (OSError, ValueError):
+                print("ERROR: can not load http cache index {0}, start with an empty cache".format(self._index_file))
+        self._bytes = sum(entry['bytes'] for entry in self._entries.values())
+        self._evict()
+
+    def _body_file(self, key):
+        return os.path.join(self._path, key + '.body')
+
+    def validators(self, url):
+        """
+        conditional request headers of a cached url.
+        :param url: url to request
+        :return: dict of request headers, empty if the url is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        headers = dict()
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def open_body(self, url):
+        """
+        open the cached body of a url answered with 304 Not Modified, counted as a hit.
+        :param url: requested url
+        :return: binary file object, None if the body is not cached any more
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            try:
+                body = open(self._body_file(entry['key']), 'rb')
+            except OSError:
+                self._drop(url)
+                return None
+            self._entries.move_to_end(url)
+            self.hits += 1
+        return body
+
+    def temp_file(self, url):
+        """
+        path to write a fresh body to before it is stored with put_file.
+        :param url: requested url
+        :return: path of the temporary body
+        """
+        os.makedirs(self._path, exist_ok=True)
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        return os.path.join(self._path, '{0}.{1}.part'.format(key, threading.get_ident()))
+
+    def put_file(self, url, headers, path):
+        """
+        store the fresh body of a url, counted as a miss.
+        bodies of responses without ETag or Last-Modified can not be revalidated and are not kept.
+        :param url: requested url
+        :param headers: response headers
+        :param path: temporary body written to the path given by temp_file
+        :return: None
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        size = os.path.getsize(path)
+        with self._lock:
+            self.misses += 1
+            if not (etag or last_modified) or size > self._max_bytes:
+                os.remove(path)
+                self._drop(url)
+                return
+            key = hashlib.sha1(url.encode('utf8')).hexdigest()
+            self._drop(url)
+            os.replace(path, self._body_file(key))
+            self._entries[url] = {'etag': etag, 'last_modified': last_modified, 'key': key, 'bytes': size}
+            self._bytes += size
+            self._evict()
+
+    def put(self, url, headers, body):
+        """
+        store the fresh body of a url already read in memory, see put_file.
+        :param url: requested url
+        :param headers: response headers
+        :param body: bytes of the body
+        :return: None
+        """
+        path = self.temp_file(url)
+        with open(path, 'wb') as f:
+            f.write(body)
+        self.put_file(url, headers, path)
+
+    def _evict(self):
+        """
+        drop the least recently used bodies until the cache fits in max_bytes, the lock must be held.
+        :return: None
+        """
+        while self._bytes > self._max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, url):
+        """
+        remove a cached url, the lock must be held.
+        :param url: cached url
+        :return: None
+        """
+        entry = self._entries.pop(url, None)
+        if entry is None:
+            return
+        self._bytes -= entry['bytes']
+        try:
+            os.remove(self._body_file(entry['key']))
+        except OSError:
+            pass
+
+    def save(self):
+        """
+        save the index, replaced atomically, entries keep their least recently used order.
+        :return: None
+        """
+        with self._lock:
+            os.makedirs(self._path, exist_ok=True)
+            tmp_file = self._index_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf8') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_file, self._index_file)
+
+    def stats(self):
+        """
+        :return: dict with 'hits', 'misses', 'entries' and 'bytes' of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._bytes}
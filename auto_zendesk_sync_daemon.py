@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Continuous sync service: changed posts and tickets are listed every few minutes and their comment threads
+are polled on tiered intervals, hot threads(open, pending, lately updated) often and cold threads rarely.
+Records are upserted into the database as they arrive, so reports read near real time data
+without a full crawl.
+"""
+
+# core mods
+import json
+import os
+import signal
+import threading
+import time
+
+# 3rd party mods
+import configure
+import auto_zendesk_timestamps as timestamps
+from auto_zendesk_pipeline import AutoZendeskDBSink
+
+# a thread is hot while open or updated less than this many seconds ago, warm until WARM_AGE, cold after
+HOT_AGE = 24 * 3600
+WARM_AGE = 7 * 24 * 3600
+# threads not updated for this long are not polled any more
+RETIRE_AGE = 30 * 24 * 3600
+
+# statuses of tickets and community posts('none' is a post without answer) keeping a thread hot
+HOT_STATUSES = ('new', 'open', 'pending', 'none')
+
+
+class AutoZendeskSyncDaemon(object):
+    def __init__(self, crawler_factory, db_factory, hot_interval=300, warm_interval=3600, cold_interval=86400,
+                 build_interval=3600, batch_size=50, tick=5):
+        """
+        Long running sync of Zendesk into the database.
+        :param crawler_factory: callable returning a new AutoZendeskCrawling, one crawler lists the changes
+                                and polls every thread so its rate limit state and connections last.
+                                output=None is enough, records go straight to the database
+        :param db_factory: callable returning a new AutoZendeskDB
+        :param hot_interval: seconds between two listings of the changes and between two polls of a hot thread
+        :param warm_interval: seconds between two polls of a warm thread
+        :param cold_interval: seconds between two polls of a cold thread
+        :param build_interval: seconds between two builds of the report tables, None never builds them
+        :param batch_size: comment threads polled between two checks of the stop request
+        :param tick: seconds slept when nothing is due
+        """
+        self._crawler_factory = crawler_factory
+        self._db_factory = db_factory
+        self._intervals = {'hot': hot_interval, 'warm': warm_interval, 'cold': cold_interval}
+        self._build_interval = build_interval
+        self._batch_size = batch_size
+        self._tick = tick
+
+        self._stop = threading.Event()
+        # upserts the records, built with the crawler at the first cycle
+        self._sink = None
+        self._crawler = None
+        # the page sink is called from the crawler workers, schedule changes are serialized
+        self._lock = threading.Lock()
+
+        # persistent schedule: every known thread and the next listing and build times
+        self._state_file = os.path.join(configure.OUTPUT_PATH, 'state', 'sync_schedule.json')
+        self._schedule = {'threads': dict(), 'next_listing': 0, 'next_build': 0}
+        self._load_schedule()
+
+    def _load_schedule(self):
+        if not os.path.exists(self._state_file):
+            return
+        try:
+            with open(self._state_file, 'r', encoding='utf8') as f:
+                self._schedule.update(json.load(f))
+        except (OSError, ValueError):
+            print("ERROR: can not load sync schedule {0}, start with an empty schedule".format(self._state_file))
+
+    def _save_schedule(self):
+        """
+        save the schedule, replaced atomically.
+        :return: None
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self._state_file), exist_ok=True)
+            tmp_file = self._state_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf8') as f:
+                json.dump(self._schedule, f)
+            os.replace(tmp_file, self._state_file)
+
+    def stop(self, *args):
+        """
+        ask the daemon to stop, the running batch finishes and the schedule is saved before run() returns.
+        usable as a signal handler.
+        :return: None
+        """
+        print("sync daemon stopping")
+        self._stop.set()
+
+    def _tier(self, thread, now):
+        age = now - timestamps.to_epoch(thread['updated_at'])
+        if thread['status'] in HOT_STATUSES or age < HOT_AGE:
+            return 'hot'
+        if age < WARM_AGE:
+            return 'warm'
+        return 'cold'
+
+    def _write_page(self, entity, parent_id, records):
+        """
+        page sink of the crawlers, upserts the records and schedules the changed threads.
+        an upsert error is raised to the crawler, the threads of a page are scheduled once the page is stored.
+        :param entity: entity type eg. 'posts'
+        :param parent_id: post or ticket id of comments
+        :param records: records of the page
+        :return: None
+        """
+        self._sink(entity, parent_id, records)
+        if records and entity in ('posts', 'tickets'):
+            with self._lock:
+                self._schedule_threads(entity, records)
+
+    def _schedule_threads(self, entity, records):
+        """
+        schedule the threads of listed posts or tickets, the lock must be held.
+        :param entity: 'posts' or 'tickets'
+        :param records: records of a listing page
+        :return: None
+        """
+        now = time.time()
+        threads = self._schedule['threads']
+        for record in records:
+            key = '{0}:{1}'.format(entity, record['id'])
+            # a post gets a new comment count, a ticket a new updated_at when its thread changes
+            version = [record.get('updated_at'), record.get('comment_count')]
+            thread = threads.get(key)
+            if thread is None or thread['version'] != version:
+                # changed since the last poll, due now
+                thread = {'version': version, 'next_poll': now}
+                threads[key] = thread
+            thread['updated_at'] = record['updated_at']
+            thread['status'] = record.get('status')
+            thread['tier'] = self._tier(thread, now)
+
+    def _due_threads(self, now):
+        """
+        threads due for a poll, hot threads first then the latest updated.
+        retired threads are dropped from the schedule.
+        :param now: current time
+        :return: list of schedule keys eg. 'posts:123'
+        """
+        threads = self._schedule['threads']
+        for key in [key for key, thread in threads.items()
+                    if now - timestamps.to_epoch(thread['updated_at']) > RETIRE_AGE]:
+            del threads[key]
+        due = [key for key, thread in threads.items() if thread['next_poll'] <= now]
+        due.sort(key=lambda key: threads[key]['updated_at'], reverse=True)
+        due.sort(key=lambda key: ('hot', 'warm', 'cold').index(threads[key]['tier']))
+        return due
+
+    def _poll_threads(self, keys):
+        """
+        poll comment threads in batches, a stop request is honoured between two batches.
+        a collected thread is scheduled for its next poll, a failed one stays due and is polled again next cycle.
+        :param keys: schedule keys of the threads
+        :return: number of threads collected
+        """
+        threads = self._schedule['threads']
+        polled = failed = 0
+        for start in range(0, len(keys), self._batch_size):
+            if self._stop.is_set():
+                break
+            batch = keys[start:start + self._batch_size]
+            collected = self._crawler.collect_comment_threads(
+                post_ids=[key[len('posts:'):] for key in batch if key.startswith('posts:')],
+                ticket_ids=[key[len('tickets:'):] for key in batch if key.startswith('tickets:')])
+            now = time.time()
+            with self._lock:
+                for entity, id0 in collected:
+                    thread = threads.get('{0}:{1}'.format(entity, id0))
+                    if thread is None:
+                        continue
+                    thread['tier'] = self._tier(thread, now)
+                    thread['next_poll'] = now + self._intervals[thread['tier']]
+            polled += len(collected)
+            failed += len(batch) - len(collected)
+            self._save_schedule()
+        if failed:
+            print("ERROR: {0} threads not collected, they stay due".format(failed))
+        return polled
+
+    def run_once(self):
+        """
+        one sync cycle: list the changes if due, poll the due threads and build the report tables if due.
+        :return: number of threads polled
+        """
+        if self._sink is None:
+            self._sink = AutoZendeskDBSink(self._db_factory())
+        if self._crawler is None:
+            self._crawler = self._crawler_factory()
+            self._crawler.set_page_sink(self._write_page)
+        now = time.time()
+        if now >= self._schedule['next_listing']:
+            self._crawler.sync_changes()
+            self._schedule['next_listing'] = now + self._intervals['hot']
+            self._save_schedule()
+
+        due = self._due_threads(time.time())
+        if due:
+            tiers = [self._schedule['threads'][key]['tier'] for key in due]
+            print("polling {0} threads: {1} hot, {2} warm, {3} cold".format(
+                len(due), tiers.count('hot'), tiers.count('warm'), tiers.count('cold')))
+            self._poll_threads(due)
+
+        if self._build_interval is not None and not self._stop.is_set() \
+                and time.time() >= self._schedule['next_build']:
+            self._sink.call('run_build_tables')
+            self._schedule['next_build'] = time.time() + self._build_interval
+            self._save_schedule()
+        return len(due)
+
+    def run(self):
+        """
+        sync until stop() is called or SIGINT/SIGTERM is received.
+        :return: None
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+        print("sync daemon started, {0} threads scheduled".format(len(self._schedule['threads'])))
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                # a failed cycle is retried at the next tick, the daemon keeps running
+                print("ERROR: sync cycle failed: {0}".format(e))
+            self._stop.wait(self._tick)
+        self._save_schedule()
+        print("sync daemon stopped")
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Crawler telemetry: request counts, latency histograms, bytes, retries and 429s per api endpoint
+and the duration of every crawl stage, written at the end of a run as a Prometheus text file and a JSON summary.
+"""
+
+# core mods
+import json
+import os
+import re
+import threading
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def endpoint_of(url):
+    """
+    endpoint label of an api url, ids are replaced so every thread of an endpoint shares one label.
+    eg. https://x.zendesk.com/api/v2/community/posts/123/comments.json?page=2 -> community/posts/{id}/comments
+    :param url: api url
+    :return: endpoint label
+    """
+    path = url.split('?', 1)[0]
+    if '/api/v2/' in path:
+        path = path.split('/api/v2/', 1)[1]
+    path = re.sub(r'\.json$', '', path)
+    return re.sub(r'(^|/)[0-9]+(?=/|$)', r'\1{id}', path)
+
+
+class CrawlTelemetry(object):
+    def __init__(self):
+        """
+        Thread safe counters of one crawl run.
+        """
+        self._lock = threading.Lock()
+        # endpoint -> counters of the endpoint
+        self._endpoints = dict()
+        # stage -> seconds
+        self._stages = dict()
+
+    def _endpoint(self, url):
+        endpoint = endpoint_of(url)
+        counters = self._endpoints.get(endpoint)
+        if counters is None:
+            counters = {'requests': dict(),
+                        'buckets': [0] * len(LATENCY_BUCKETS),
+                        'latency_sum': 0.0,
+                        'latency_count': 0,
+                        'bytes': 0,
+                        'retries': 0,
+                        'throttled': 0}
+            self._endpoints[endpoint] = counters
+        return counters
+
+    def observe_request(self, url, status, latency, attempt=0):
+        """
+        record one request sent to the api.
+        :param url: requested url
+        :param status: http status code, 'error' if no response was received
+        :param latency: seconds to the response headers
+        :param attempt: number of the attempt, retries are attempts after the first
+        :return: None
+        """
+        with self._lock:
+            counters = self._endpoint(url)
+            status = str(status)
+            counters['requests'][status] = counters['requests'].get(status, 0) + 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    counters['buckets'][i] += 1
+            counters['latency_sum'] += latency
+            counters['latency_count'] += 1
+            if attempt:
+                counters['retries'] += 1
+            if status == '429':
+                counters['throttled'] += 1
+
+    def observe_bytes(self, url, size):
+        """
+        record bytes of a response body received from the api.
+        :param url: requested url
+        :param size: number of bytes
+        :return: None
+        """
+        with self._lock:
+            self._endpoint(url)['bytes'] += size
+
+    def observe_stage(self, stage, seconds):
+        """
+        record the duration of a crawl stage.
+        :param stage: 'posts', 'comments'...
+        :param seconds: duration of the stage
+        :return: None
+        """
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0.0) + seconds
+
+    def summary(self):
+        """
+        :return: dict with 'endpoints' and 'stages', every latency histogram bucket is cumulative
+        """
+        with self._lock:
+            endpoints = dict()
+            for endpoint, counters in sorted(self._endpoints.items()):
+                endpoints[endpoint] = {
+                    'requests': dict(counters['requests']),
+                    'latency_buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS], counters['buckets'])),
+                    'latency_sum': counters['latency_sum'],
+                    'latency_count': counters['latency_count'],
+                    'latency_avg': counters['latency_sum'] / counters['latency_count']
+                    if counters['latency_count'] else 0.0,
+                    'bytes': counters['bytes'],
+                    'retries': counters['retries'],
+                    'throttled': counters['throttled']}
+            return {'endpoints': endpoints, 'stages': dict(self._stages)}
+
+    def to_prometheus(self):
+        """
+        counters in the Prometheus text exposition format.
+        :return: str
+        """
+        summary = self.summary()
+        lines = ['# HELP zendesk_requests_total Requests sent to the Zendesk api.',
+                 '# TYPE zendesk_requests_total counter']
+        for endpoint, counters in summary['endpoints'].items():
+            for status, count in sorted(counters['requests'].items()):
+                lines.append('zendesk_requests_total{{endpoint="{0}",status="{1}"}} {2}'.format(
+                    endpoint, status, count))
+
+        lines += ['# HELP zendesk_request_duration_seconds Seconds to the response headers of the Zendesk api.',
+                  '# TYPE zendesk_request_duration_seconds histogram']
+        for endpoint, counters in summary['endpoints'].items():
+            for bound, count in counters['latency_buckets'].items():
+                lines.append('zendesk_request_duration_seconds_bucket{{endpoint="{0}",le="{1}"}} {2}'.format(
+                    endpoint, bound, count))
+            lines.append('zendesk_request_duration_seconds_bucket{{endpoint="{0}",le="+Inf"}} {1}'.format(
+                endpoint, counters['latency_count']))
+            lines.append('zendesk_request_duration_seconds_sum{{endpoint="{0}"}} {1}'.format(
+                endpoint, counters['latency_sum']))
+            lines.append('zendesk_request_duration_seconds_count{{endpoint="{0}"}} {1}'.format(
+                endpoint, counters['latency_count']))
+
+        for name, key, help_text in (('zendesk_response_bytes_total', 'bytes', 'Response bytes received.'),
+                                     ('zendesk_retries_total', 'retries', 'Requests retried after a failure.'),
+                                     ('zendesk_throttled_total', 'throttled', 'Requests answered with 429.')):
+            lines += ['# HELP {0} {1}'.format(name, help_text), '# TYPE {0} counter'.format(name)]
+            for endpoint, counters in summary['endpoints'].items():
+                lines.append('{0}{{endpoint="{1}"}} {2}'.format(name, endpoint, counters[key]))
+
+        lines += ['# HELP zendesk_stage_duration_seconds Duration of the crawl stages.',
+                  '# TYPE zendesk_stage_duration_seconds gauge']
+        for stage, seconds in summary['stages'].items():
+            lines.append('zendesk_stage_duration_seconds{{stage="{0}"}} {1}'.format(stage, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, root_path, run_id):
+        """
+        write root_path/metrics/<run_id>.prom and root_path/metrics/<run_id>.json.
+        :param root_path: output path
+        :param run_id: id of the crawl run
+        :return: path of the Prometheus file
+        """
+        metrics_path = os.path.join(root_path, 'metrics')
+        os.makedirs(metrics_path, exist_ok=True)
+        prom_file = os.path.join(metrics_path, run_id + '.prom')
+        json_file = os.path.join(metrics_path, run_id + '.json')
+        for path, text in ((prom_file, self.to_prometheus()),
+                           (json_file, json.dumps(self.summary(), indent=2))):
+            # written whole then renamed, a node exporter textfile collector never reads half a file
+            with open(path + '.tmp', 'w', encoding='utf8') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+        return prom_file
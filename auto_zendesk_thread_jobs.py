@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Distributed comment collection: the comment threads to collect are queued in the isv_thread_jobs table
+of the database, and crawler workers on any number of machines claim them with FOR UPDATE SKIP LOCKED,
+collect them and mark them done. A worker that dies loses its lease and its threads are claimed again.
+
+    python auto_zendesk_thread_jobs.py --publish --token <token>     list the changes and queue their threads
+    python auto_zendesk_thread_jobs.py --token <token>                run a worker, on as many machines as needed
+"""
+
+# core mods
+import argparse
+import os
+import signal
+import socket
+import threading
+
+# 3rd party mods
+from auto_zendesk_pipeline import AutoZendeskDBSink
+
+
+class AutoZendeskThreadWorker(object):
+    def __init__(self, crawler_factory, db_factory, worker_id=None, batch_size=20, lease=600, max_attempts=5,
+                 idle_wait=10, exit_when_idle=False):
+        """
+        Claim comment threads from the job table, collect them and upsert their comments.
+        :param crawler_factory: callable returning a new AutoZendeskCrawling, one crawler collects every batch
+                                so its rate limit state lasts. output=None is enough, records go straight
+                                to the database
+        :param db_factory: callable returning a new AutoZendeskDB holding the job table
+        :param worker_id: id of the worker in the job table, defaults to <host name>:<pid>
+        :param batch_size: threads claimed at a time
+        :param lease: seconds a claimed batch is leased for, other workers claim it again once the lease expires.
+                      must be longer than the collection of a batch
+        :param max_attempts: claims of a thread before it is marked failed
+        :param idle_wait: seconds waited when no thread is queued
+        :param exit_when_idle: stop once the queue is empty instead of waiting for new threads
+        """
+        self._crawler_factory = crawler_factory
+        self._db_factory = db_factory
+        self._worker_id = worker_id or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self._batch_size = batch_size
+        self._lease = lease
+        self._max_attempts = max_attempts
+        self._idle_wait = idle_wait
+        self._exit_when_idle = exit_when_idle
+
+        self._stop = threading.Event()
+        # upserts the comments and holds the connection of the job table, built with the crawler at the first batch
+        self._sink = None
+        self._crawler = None
+
+    def stop(self, *args):
+        """
+        ask the worker to stop, the running batch finishes first. usable as a signal handler.
+        :return: None
+        """
+        print("thread worker {0} stopping".format(self._worker_id))
+        self._stop.set()
+
+    def run_once(self):
+        """
+        claim one batch of threads, collect it and record the result in the job table.
+        :return: number of threads claimed
+        """
+        if self._sink is None:
+            self._sink = AutoZendeskDBSink(self._db_factory())
+        if self._crawler is None:
+            self._crawler = self._crawler_factory()
+            self._crawler.set_page_sink(self._sink)
+        threads = self._sink.call('claim_thread_jobs', self._worker_id, self._batch_size, self._lease,
+                                  self._max_attempts)
+        if not threads:
+            return 0
+
+        try:
+            # a thread whose page was not fetched or not stored is not in collected
+            collected = self._crawler.collect_comment_threads(
+                post_ids=[id0 for entity, id0 in threads if entity == 'posts'],
+                ticket_ids=[id0 for entity, id0 in threads if entity == 'tickets'])
+            error = 'page not collected or not stored'
+        except Exception as e:
+            collected = []
+            error = str(e)
+            print("ERROR: thread worker {0} batch failed: {1}".format(self._worker_id, e))
+        collected = set(collected)
+        failed = [thread for thread in threads if thread not in collected]
+        self._sink.call('complete_thread_jobs', self._worker_id, sorted(collected))
+        self._sink.call('fail_thread_jobs', self._worker_id, failed, error, self._max_attempts)
+        print("thread worker {0}: {1} threads collected, {2} failed".format(self._worker_id, len(collected),
+                                                                           len(failed)))
+        return len(threads)
+
+    def run(self):
+        """
+        work until stop() is called, SIGINT/SIGTERM is received or, with exit_when_idle, the queue is empty.
+        :return: None
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+        print("thread worker {0} started".format(self._worker_id))
+        while not self._stop.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception as e:
+                # the database may be away for a moment, the claim is retried after idle_wait
+                print("ERROR: thread worker {0} failed: {1}".format(self._worker_id, e))
+                claimed = 0
+            if not claimed:
+                if self._exit_when_idle:
+                    break
+                self._stop.wait(self._idle_wait)
+        print("thread worker {0} stopped".format(self._worker_id))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='distributed collection of Zendesk comment threads')
+    parser.add_argument('--publish', action='store_true',
+                        help='list the changed posts and tickets and queue their comment threads')
+    parser.add_argument('--token', default='', help='Authorization header of the Zendesk api')
+    parser.add_argument('--subdomain', default='jetadvantage')
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--rate-limit', type=int, default=400,
+                        help='requests per minute of this worker, the workers share the account rate limit')
+    parser.add_argument('--batch-size', type=int, default=20)
+    parser.add_argument('--lease', type=int, default=600)
+    parser.add_argument('--exit-when-idle', action='store_true')
+    parser.add_argument('--dbname', default='isv_zendesk')
+    parser.add_argument('--dbuser', default='postgres')
+    parser.add_argument('--dbpasswd', default='')
+    parser.add_argument('--dbhost', default='127.0.0.1')
+    parser.add_argument('--dbport', default='5432')
+    args = parser.parse_args()
+
+    from auto_zendesk_crawling_new import AutoZendeskCrawling
+    from auto_zendesk_db import AutoZendeskDB
+
+    def new_db():
+        return AutoZendeskDB(args.dbname, args.dbuser, args.dbpasswd, args.dbhost, args.dbport)
+
+    if args.publish:
+        db = new_db()
+        crawler = AutoZendeskCrawling(token=args.token, subdomain=args.subdomain, max_workers=args.max_workers,
+                                      rate_limit=args.rate_limit, incremental=True, db=db, output=None)
+        crawler.set_page_sink(AutoZendeskDBSink(db))
+        crawler.sync_changes()
+        crawler.publish_thread_jobs(db)
+        print(db.get_thread_jobs_counts())
+    else:
+        AutoZendeskThreadWorker(lambda: AutoZendeskCrawling(token=args.token, subdomain=args.subdomain,
+                                                            max_workers=args.max_workers,
+                                                            rate_limit=args.rate_limit, output=None),
+                                new_db, batch_size=args.batch_size, lease=args.lease,
+                                exit_when_idle=args.exit_when_idle).run()
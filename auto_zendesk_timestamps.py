@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Timestamp helpers shared by the crawler and the sync services.
+Zendesk timestamps have a fixed format(2018-01-18T14:06:16Z), so their string order is their time order:
+a record is checked against a collection window by comparing strings, without parsing it.
+"""
+
+# core mods
+import array
+import calendar
+import datetime
+import functools
+import time
+
+ZENDESK_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def format_timestamp(seconds):
+    """
+    :param seconds: seconds since epoch
+    :return: Zendesk timestamp eg. 2018-01-18T14:06:16Z
+    """
+    return time.strftime(ZENDESK_FORMAT, time.gmtime(seconds))
+
+
+def window_start(days, now=None):
+    """
+    start of a window of the last days, computed once and compared with is_after() for every record.
+    :param days: length of the window in days
+    :param now: seconds since epoch, defaults to the current time
+    :return: Zendesk timestamp
+    """
+    return format_timestamp((time.time() if now is None else now) - days * 24 * 3600)
+
+
+def _is_fixed(timestamp):
+    return len(timestamp) == 20 and timestamp[10] == 'T' and timestamp[19] == 'Z'
+
+
+@functools.lru_cache(maxsize=65536)
+def to_epoch(timestamp):
+    """
+    seconds since epoch of a timestamp, the fixed Zendesk format is read by position instead of strptime.
+    other ISO-8601 timestamps(fractions of seconds, utc offsets) are parsed with datetime.
+    results are cached, the sync daemon parses the same timestamps on every tick.
+    :param timestamp: Zendesk timestamp eg. 2018-01-18T14:06:16Z
+    :return: seconds since epoch
+    """
+    if _is_fixed(timestamp):
+        return calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                                int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]), 0, 0, 0))
+    parsed = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp())
+
+
+def is_after(timestamp, start):
+    """
+    check a timestamp is after the start of a window.
+    :param timestamp: timestamp of a record
+    :param start: Zendesk timestamp from window_start()
+    :return: True if timestamp is later than start
+    """
+    if _is_fixed(timestamp):
+        # string order is time order
+        return timestamp > start
+    return to_epoch(timestamp) > to_epoch(start)
+
+
+def id_array(ids=()):
+    """
+    compact array of record ids, 8 bytes per id instead of a str object.
+    :param ids: ids as int or str
+    :return: array('q')
+    """
+    return array.array('q', (int(id0) for id0 in ids))
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Copyright 2018 Francis Xufan Du - BEYONDSOFT INC.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: Francis Xufan Du - BEYONDSOFT INC.
+@email: duxufan@beyondsoft.com xufan.du@gmail.com
+
+Webhook receiver for push based updates: Zendesk webhooks(event or trigger payloads) about tickets,
+posts and their comments are validated with the webhook signing secret, and only the affected tickets
+and posts are collected again and upserted into the database.
+
+    python auto_zendesk_webhook.py --secret <signing secret>
+    python auto_zendesk_webhook.py --secret <signing secret> --send-samples http://127.0.0.1:8766/webhook
+
+A trigger or automation webhook can send a body like {"ticket_id": "{{ticket.id}}"}.
+"""
+
+# core mods
+import argparse
+import base64
+import calendar
+import hashlib
+import hmac
+import http.server
+import json
+import queue
+import threading
+import time
+
+# 3rd party mods
+import requests
+from auto_zendesk_pipeline import AutoZendeskDBSink
+
+# headers of the Zendesk webhook signature, base64(HMAC-SHA256(secret, timestamp + body))
+SIGNATURE_HEADER = 'X-Zendesk-Webhook-Signature'
+TIMESTAMP_HEADER = 'X-Zendesk-Webhook-Signature-Timestamp'
+
+# payloads sent by send_samples()
+SAMPLE_PAYLOADS = (
+    {'type': 'zen:event-type:ticket.comment_added', 'detail': {'id': '1'}},
+    {'type': 'zen:event-type:ticket.status_changed', 'detail': {'id': '2'}},
+    {'type': 'zen:event-type:community_post.comment_created', 'detail': {'post_id': '3', 'id': '3001'}},
+    {'ticket_id': '4'},
+    {'post_id': '5'},
+)
+
+
+def sign(secret, timestamp, body):
+    """
+    signature of a webhook body the way Zendesk computes it.
+    :param secret: webhook signing secret
+    :param timestamp: value of the timestamp header
+    :param body: bytes of the body
+    :return: base64 signature
+    """
+    digest = hmac.new(secret.encode('utf8'), timestamp.encode('utf8') + body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def parse_payload(data):
+    """
+    tickets and posts a webhook payload is about.
+    event webhooks give the type zen:event-type:<ticket|community_post>.<event> with the id in detail,
+    trigger webhooks give ticket_id or post_id.
+    :param data: parsed payload
+    :return: list of ('tickets'|'posts', id)
+    """
+    targets = []
+    if not isinstance(data, dict):
+        return targets
+    event = str(data.get('type', ''))
+    detail = data.get('detail') if isinstance(data.get('detail'), dict) else dict()
+    if event.startswith('zen:event-type:ticket.'):
+        targets.append(('tickets', detail.get('id')))
+    elif event.startswith('zen:event-type:community_post.'):
+        # the id of a comment event is the comment id, the post is in post_id
+        targets.append(('posts', detail.get('post_id', detail.get('id'))))
+    if 'ticket_id' in data:
+        targets.append(('tickets', data['ticket_id']))
+    if 'post_id' in data:
+        targets.append(('posts', data['post_id']))
+    return [(entity, str(id0)) for entity, id0 in targets if id0 is not None and str(id0).isdigit()]
+
+
+def send_webhook(url, secret, payload, timeout=10):
+    """
+    post a signed payload like Zendesk does, the local stand-in used to test the receiver.
+    :param url: url of the receiver
+    :param secret: webhook signing secret
+    :param payload: dict of the payload
+    :return: http status code
+    """
+    body = json.dumps(payload).encode('utf8')
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    r = requests.post(url, data=body, timeout=timeout,
+                      headers={'Content-Type': 'application/json',
+                               SIGNATURE_HEADER: sign(secret, timestamp, body),
+                               TIMESTAMP_HEADER: timestamp})
+    return r.status_code
+
+
+def send_samples(url, secret):
+    for payload in SAMPLE_PAYLOADS:
+        print("{0} {1}".format(send_webhook(url, secret, payload), json.dumps(payload)))
+
+
+class AutoZendeskWebhookReceiver(object):
+    def __init__(self, crawler_factory, db_factory, secret, host='127.0.0.1', port=8766, max_age=300,
+                 batch_wait=1.0, queue_size=10000, max_attempts=3):
+        """
+        Receive Zendesk webhooks and collect again the tickets and posts they are about.
+        :param crawler_factory: callable returning a new AutoZendeskCrawling built with output=None,
+                                one crawler collects every batch so its rate limit state lasts
+        :param db_factory: callable returning a new AutoZendeskDB
+        :param secret: webhook signing secret, requests without a valid signature are answered 401
+        :param host: address to listen on, Zendesk reaches it through a public reverse proxy
+        :param port: port to listen on, 0 picks a free port
+        :param max_age: seconds a signature timestamp stays valid, older requests are refused as replays
+        :param batch_wait: seconds the refetch worker waits to group webhooks arriving together
+        :param queue_size: maximum number of queued targets, the receiver answers 503 when full
+        :param max_attempts: refetches of a target before it is given up, a failed refetch is queued again
+        """
+        self._crawler_factory = crawler_factory
+        self._db_factory = db_factory
+        self._secret = secret
+        self._max_age = max_age
+        self._batch_wait = batch_wait
+        self._max_attempts = max_attempts
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        # targets queued and not collected yet, a burst of webhooks about one ticket is collected once
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # failed refetches of the queued targets
+        self._attempts = dict()
+        # upserts the collected records, built with the crawler by the refetch worker
+        self._sink = None
+        self._crawler = None
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), self._build_handler())
+        self._httpd.daemon_threads = True
+        self._threads = []
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/webhook'.format(*self._httpd.server_address[:2])
+
+    def validate(self, headers, body):
+        """
+        check the signature and the age of a webhook.
+        :param headers: request headers
+        :param body: bytes of the body
+        :return: True if the webhook is signed with the secret and recent
+        """
+        signature = headers.get(SIGNATURE_HEADER)
+        timestamp = headers.get(TIMESTAMP_HEADER)
+        if not signature or not timestamp:
+            return False
+        if not hmac.compare_digest(sign(self._secret, timestamp, body), signature):
+            return False
+        try:
+            sent_at = calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+        except ValueError:
+            return False
+        return abs(time.time() - sent_at) <= self._max_age
+
+    def enqueue(self, targets):
+        """
+        queue tickets and posts to collect again.
+        :param targets: list of ('tickets'|'posts', id)
+        :return: False if the queue is full
+        """
+        for target in targets:
+            with self._lock:
+                if target in self._pending:
+                    continue
+                self._pending.add(target)
+            try:
+                self._queue.put_nowait(target)
+            except queue.Full:
+                with self._lock:
+                    self._pending.discard(target)
+                return False
+        return True
+
+    def _refetch_worker(self):
+        """
+        collect the queued targets in batches, webhooks arriving within batch_wait are grouped.
+        :return: None
+        """
+        self._sink = AutoZendeskDBSink(self._db_factory())
+        self._crawler = self._crawler_factory()
+        self._crawler.set_page_sink(self._sink)
+        while not self._stop.is_set():
+            try:
+                batch = [self._queue.get(timeout=self._batch_wait)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self._batch_wait
+            while time.monotonic() < deadline:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            with self._lock:
+                self._pending.difference_update(batch)
+
+            post_ids = [id0 for entity, id0 in batch if entity == 'posts']
+            ticket_ids = [id0 for entity, id0 in batch if entity == 'tickets']
+            print("webhook refetch of {0} posts and {1} tickets".format(len(post_ids), len(ticket_ids)))
+            try:
+                collected = set(self._crawler.refetch(post_ids=post_ids, ticket_ids=ticket_ids))
+            except Exception as e:
+                print("ERROR: webhook refetch failed: {0}".format(e))
+                collected = set()
+            self._retry([target for target in batch if target not in collected])
+            for target in collected:
+                self._attempts.pop(target, None)
+
+    def _retry(self, targets):
+        """
+        queue again the targets whose refetch failed, a target failing max_attempts times is given up.
+        :param targets: list of ('tickets'|'posts', id)
+        :return: None
+        """
+        retry = []
+        for target in targets:
+            self._attempts[target] = self._attempts.get(target, 0) + 1
+            if self._attempts[target] >= self._max_attempts:
+                del self._attempts[target]
+                print("ERROR: webhook refetch of {0} {1} failed {2} times, given up".format(
+                    target[0], target[1], self._max_attempts))
+            else:
+                retry.append(target)
+        if retry and not self.enqueue(retry):
+            print("ERROR: webhook queue full, failed refetches not all queued again")
+
+    def _build_handler(self):
+        receiver = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _answer(self, status, message):
+                body = json.dumps({'status': message}).encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if self.path.split('?', 1)[0] != '/webhook':
+                    self._answer(404, 'not found')
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    length = 0
+                body = self.rfile.read(length)
+                if not receiver.validate(self.headers, body):
+                    self._answer(401, 'invalid signature')
+                    return
+                try:
+                    targets = parse_payload(json.loads(body.decode('utf8')))
+                except ValueError:
+                    self._answer(400, 'invalid json')
+                    return
+                if not targets:
+                    self._answer(400, 'no ticket or post in payload')
+                    return
+                if not receiver.enqueue(targets):
+                    self._answer(503, 'queue full')
+                    return
+                self._answer(202, 'queued')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """
+        serve and refetch in background threads.
+        :return: None
+        """
+        self._threads = [threading.Thread(target=self._httpd.serve_forever, name='webhook-http', daemon=True),
+                         threading.Thread(target=self._refetch_worker, name='webhook-refetch', daemon=True)]
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        """
+        stop receiving, the running refetch finishes first.
+        :return: None
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._stop.set()
+        for t in self._threads[1:]:
+            t.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Zendesk webhook receiver')
+    parser.add_argument('--secret', required=True, help='webhook signing secret')
+    parser.add_argument('--send-samples', metavar='URL', help='post the sample payloads to a running receiver')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--token', default='', help='Authorization header of the Zendesk api')
+    parser.add_argument('--dbname', default='isv_zendesk')
+    parser.add_argument('--dbuser', default='postgres')
+    parser.add_argument('--dbpasswd', default='')
+    parser.add_argument('--dbhost', default='127.0.0.1')
+    parser.add_argument('--dbport', default='5432')
+    args = parser.parse_args()
+
+    if args.send_samples:
+        send_samples(args.send_samples, args.secret)
+    else:
+        from auto_zendesk_crawling_new import AutoZendeskCrawling
+        from auto_zendesk_db import AutoZendeskDB
+
+        receiver = AutoZendeskWebhookReceiver(
+            lambda: AutoZendeskCrawling(token=args.token, output=None),
+            lambda: AutoZendeskDB(args.dbname, args.dbuser, args.dbpasswd, args.dbhost, args.dbport),
+            args.secret, host=args.host, port=args.port)
+        receiver.start()
+        print("webhook receiver on {0}".format(receiver.url))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            receiver.stop()
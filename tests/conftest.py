@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+# the modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# configure.py is written for each deployment and is not in the repository, the tests use a stub
+configure = types.ModuleType('configure')
+configure.OUTPUT_PATH = tempfile.mkdtemp(prefix='zendesk_tests_')
+sys.modules['configure'] = configure
+
+
+@pytest.fixture(autouse=True)
+def output_path(tmp_path, monkeypatch):
+    """
+    point configure.OUTPUT_PATH at the temporary folder of the test.
+    :return: path of the folder
+    """
+    monkeypatch.setattr(configure, 'OUTPUT_PATH', str(tmp_path))
+    return str(tmp_path)
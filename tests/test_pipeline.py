@@ -0,0 +1,26 @@
+import threading
+
+from auto_zendesk_crawling_new import AutoZendeskCrawling
+from auto_zendesk_mock_server import AutoZendeskMockServer
+from auto_zendesk_pipeline import AutoZendeskPipeline
+
+
+def test_run_returns_when_the_database_can_not_be_opened(tmp_path):
+    mock = AutoZendeskMockServer(posts=40, tickets=40, page_size=10)
+    mock.start()
+    try:
+        crawler = AutoZendeskCrawling(token='Basic bW9jaw==', max_workers=2, api_url=mock.url, output=None,
+                                      save_path=str(tmp_path))
+
+        def db_factory():
+            raise RuntimeError('connection refused')
+
+        pipeline = AutoZendeskPipeline(crawler, db_factory, queue_size=2)
+        result = []
+        t = threading.Thread(target=lambda: result.append(pipeline.run()), daemon=True)
+        t.start()
+        t.join(60)
+        assert not t.is_alive()
+        assert result == [False]
+    finally:
+        mock.stop()
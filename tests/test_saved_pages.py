@@ -0,0 +1,43 @@
+import json
+import os
+
+from auto_zendesk_crawling_new import AutoZendeskCrawling
+from auto_zendesk_mock_server import AutoZendeskMockServer
+
+
+def test_page_that_is_not_json_is_not_collected(tmp_path):
+    mock = AutoZendeskMockServer(posts=60, tickets=20, page_size=20)
+    mock.start()
+    try:
+        crawler = AutoZendeskCrawling(token='Basic bW9jaw==', max_workers=2, api_url=mock.url,
+                                      save_path=str(tmp_path))
+        iter_body = crawler._iter_body
+
+        def truncated_body(url, r, cached):
+            body = b''.join(iter_body(url, r, cached))
+            if 'community/posts.json?page=2' in url:
+                body = body[:len(body) // 2]
+            yield body
+
+        crawler._iter_body = truncated_body
+        crawler.run_all()
+
+        assert not os.path.exists(str(tmp_path / 'post2.json'))
+        assert [os.path.basename(path) for path in crawler._manifest.files('posts')] == ['post1.json', 'post3.json']
+        assert 2 not in crawler._checkpoint_stage('posts')['pages']
+    finally:
+        mock.stop()
+
+
+def test_unreadable_page_is_skipped(tmp_path):
+    crawler = AutoZendeskCrawling(token='Basic x', save_path=str(tmp_path))
+    crawler._open_run('test')
+    crawler._window = '2018-01-01T00:00:00Z'
+    with open(str(tmp_path / 'post1.json'), 'w', encoding='utf8') as f:
+        f.write('{"posts": [')
+    with open(str(tmp_path / 'post2.json'), 'w', encoding='utf8') as f:
+        json.dump({'posts': [{'id': 7, 'updated_at': '2018-01-18T14:06:16Z', 'comment_count': 1}]}, f)
+
+    crawler._json_posts_filename_list = [str(tmp_path / 'post1.json'), str(tmp_path / 'post2.json')]
+    crawler._parse_json_posts_file()
+    assert list(crawler._posts_id) == [7]
@@ -0,0 +1,27 @@
+import collections
+
+from auto_zendesk_crawling_new import AutoZendeskCrawling
+from auto_zendesk_mock_server import AutoZendeskMockServer
+
+
+def test_every_sync_call_lists_tickets(tmp_path):
+    mock = AutoZendeskMockServer(posts=20, tickets=40, page_size=10)
+    mock.start()
+    try:
+        # the sync daemon reuses one crawler for every cycle
+        crawler = AutoZendeskCrawling(token='Basic bW9jaw==', max_workers=2, api_url=mock.url, output=None,
+                                      save_path=str(tmp_path))
+        pages = collections.Counter()
+        crawler.set_page_sink(lambda entity, parent_id, records: pages.update([entity]))
+
+        crawler.sync_changes()
+        assert pages['tickets'] == 4
+        assert pages['posts'] >= 1
+
+        pages.clear()
+        crawler.sync_changes()
+        # the export goes on from the saved cursor, one page with no change
+        assert pages['tickets'] == 1
+        assert pages['posts'] >= 1
+    finally:
+        mock.stop()
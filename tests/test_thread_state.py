@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('xlwt')
+
+import auto_zendesk_storage as storage
+import auto_zendesk_timestamps as timestamps
+from auto_zendesk_crawling_new import AutoZendeskCrawling
+from auto_zendesk_db import AutoZendeskDB
+from auto_zendesk_mock_server import AutoZendeskMockServer
+
+
+class FakeCursor(object):
+    def __init__(self, tables):
+        self._tables = tables
+        self._rows = []
+
+    def execute(self, command, args=None):
+        table = command.split(' FROM ')[1].split()[0]
+        # rows are (entity, columns...), the only filter used is WHERE entity = %s
+        self._rows = [row[1:] for row in self._tables.get(table, []) if args is None or row[0] == args[0]]
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, tables):
+        self._tables = tables
+
+    def cursor(self):
+        return FakeCursor(self._tables)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _db(tables):
+    db = AutoZendeskDB.__new__(AutoZendeskDB)
+    db._postgresql_conn = FakeConnection(tables)
+    return db
+
+
+class StateDB(object):
+    """ thread state of the database, what the crawler reads from AutoZendeskDB """
+    def __init__(self, records=()):
+        self._records = list(records)
+
+    def get_posts_thread_state(self):
+        return dict((r['thread_id'], (r['updated_at'], r['comment_count']))
+                    for r in self._records if r['entity'] == 'posts')
+
+    def get_tickets_thread_state(self):
+        return dict((r['thread_id'], r['updated_at']) for r in self._records if r['entity'] == 'tickets')
+
+    def get_known_user_ids(self):
+        return set()
+
+
+def test_stored_ticket_thread_is_skipped(tmp_path):
+    stored = timestamps.format_timestamp(time.time() - 3600)
+    changed = timestamps.format_timestamp(time.time() - 60)
+    db = _db({'isv_thread_state': [('tickets', '1', stored, None), ('tickets', '2', stored, None),
+                                   ('posts', '1', stored, 4)]})
+    assert db.get_tickets_thread_state() == {'1': stored, '2': stored}
+    assert db.get_posts_thread_state() == {'1': (stored, 4)}
+
+    crawler = AutoZendeskCrawling(token='Basic x', output=None, db=db, save_path=str(tmp_path))
+    crawler._observed['tickets'] = [{'id': 1, 'updated_at': stored, 'status': 'open'},
+                                    {'id': 2, 'updated_at': changed, 'status': 'open'},
+                                    {'id': 3, 'updated_at': changed, 'status': 'open'}]
+    crawler._load_thread_state()
+    crawler._parse_json_tickets_file()
+    assert list(crawler._tickets_id) == [2, 3]
+
+
+def test_thread_not_collected_is_collected_again(tmp_path):
+    mock = AutoZendeskMockServer(posts=10, tickets=10, page_size=10)
+    mock.start()
+    try:
+        crawler = AutoZendeskCrawling(token='Basic bW9jaw==', max_workers=2, api_url=mock.url, db=StateDB(),
+                                      save_path=str(tmp_path / 'first'))
+        collect = crawler._collect_data_from_api
+
+        def collect_failing_post_3(url, file_name, keep_data=False):
+            if url.endswith('community/posts/3/comments.json'):
+                return None
+            return collect(url, file_name, keep_data)
+
+        crawler._collect_data_from_api = collect_failing_post_3
+        crawler.run_all()
+        assert 3 in crawler._posts_id
+        records = [record for _, record in storage.iter_file_records(crawler._manifest.files('thread_state'),
+                                                                     'thread_state')]
+        assert ('posts', '3') not in [(r['entity'], r['thread_id']) for r in records]
+        assert len(records) == len(crawler._posts_id) + len(crawler._tickets_id) - 1
+
+        # the next crawl only collects the thread whose comments were not stored
+        crawler = AutoZendeskCrawling(token='Basic bW9jaw==', max_workers=2, api_url=mock.url,
+                                      db=StateDB(records), save_path=str(tmp_path / 'second'))
+        crawler.run_all()
+        assert list(crawler._posts_id) == [3]
+        assert list(crawler._tickets_id) == []
+    finally:
+        mock.stop()